@@ -1,54 +1,254 @@
+import cPickle
+import hashlib
+import marshal
+import os
+import tempfile
+from collections import OrderedDict
 from time import time
 
 import numpy as np
+from multiprocessing.pool import ThreadPool
 import theano
 import theano.tensor as T
 from theano.sandbox.linalg.ops import diag as theano_diag
 
 from utils import rect
 from theano.ifelse import ifelse
+try:
+    from theano.sandbox.cuda import CudaNdarrayType
+    from theano.sandbox.cuda.basic_ops import gpu_from_host
+except ImportError:
+    CudaNdarrayType = None
 DEBUG_INFO = False
+# Default backend for new signals, either 'theano' or 'numpy'
+BACKEND = 'theano'
 PRINT_CONVERGENCE = False
+# Orders in which Signals can update layers, see ECA.plan()
+ORDERS = ('bottom-up', 'top-down', 'jacobi')
+# Directory for storing compiled functions between runs, None disables
+FUNCTION_CACHE_DIR = None
 FLOATX = theano.config.floatX
 
 
-def lerp(old, new, min_tau=0.0, en=None):
+class TheanoOps(object):
+    """
+    Tensor operations used by the layer math. These build a symbolic graph
+    that is compiled into theano functions.
+    """
+    dot = staticmethod(T.dot)
+    sqr = staticmethod(T.sqr)
+    sqrt = staticmethod(T.sqrt)
+    log = staticmethod(T.log)
+    mean = staticmethod(T.mean)
+    var = staticmethod(T.var)
+    sum = staticmethod(T.sum)
+    concatenate = staticmethod(T.concatenate)
+    max = staticmethod(T.max)
+    maximum = staticmethod(T.maximum)
+    where = staticmethod(T.where)
+    any = staticmethod(T.any)
+    isnan = staticmethod(T.isnan)
+    zeros_like = staticmethod(T.zeros_like)
+    diagonal = staticmethod(T.diagonal)
+    diag = staticmethod(theano_diag)
+    cast = staticmethod(T.cast)
+    ifelse = staticmethod(ifelse)
+    # Shared variables are used as such in the graph
+    value = staticmethod(lambda v: v)
+
+
+class NumpyOps(object):
+    """
+    Same operations as TheanoOps but evaluated immediately with numpy, which
+    avoids compilation altogether.
+    """
+    dot = staticmethod(np.dot)
+    sqr = staticmethod(np.square)
+    sqrt = staticmethod(np.sqrt)
+    log = staticmethod(np.log)
+    mean = staticmethod(np.mean)
+    var = staticmethod(np.var)
+    sum = staticmethod(np.sum)
+    concatenate = staticmethod(np.concatenate)
+    max = staticmethod(np.max)
+    maximum = staticmethod(np.maximum)
+    where = staticmethod(np.where)
+    any = staticmethod(np.any)
+    isnan = staticmethod(np.isnan)
+    zeros_like = staticmethod(np.zeros_like)
+    diagonal = staticmethod(np.diagonal)
+    diag = staticmethod(np.diag)
+    cast = staticmethod(lambda x, dtype: np.asarray(x, dtype=dtype))
+    ifelse = staticmethod(lambda cond, then, other: then if cond else other)
+    # Operate directly on the memory of shared variables
+    value = staticmethod(lambda v: v.get_value(borrow=True))
+
+BACKENDS = {'theano': TheanoOps, 'numpy': NumpyOps}
+
+
+# Thread pools for jacobi propagation by number of threads, shared by all
+# signals so that creating signals does not leave threads behind
+POOLS = {}
+
+
+def thread_pool(threads):
+    if threads not in POOLS:
+        POOLS[threads] = ThreadPool(threads)
+    return POOLS[threads]
+
+
+def state_inputs(signals, outputs):
+    """
+    Find the signal states the given expressions depend on and return their
+    keys together with givens that replace them with symbolic inputs. This
+    makes the compiled function independent of the signals instance.
+    """
+    used = theano.gof.graph.inputs(outputs)
+    buffers = signals.buffers()
+    keys = sorted(k for k, v in buffers.items() if v in used)
+    givens = [(buffers[k], buffers[k].type(k)) for k in keys]
+    return keys, givens
+
+
+def on_device(new, states):
+    """
+    Return the new values of states as outputs that stay in the memory of
+    the states. On a GPU a plain output is moved to the host, and writing
+    it back to the state would move it to the GPU again.
+    """
+    on_gpu = lambda s: CudaNdarrayType and isinstance(s.type, CudaNdarrayType)
+    return [gpu_from_host(x) if on_gpu(s) and not on_gpu(x) else x
+            for x, s in zip(new, states)]
+
+
+def code_key(f, seen=None):
+    """
+    Return a string identifying the computation of a python function, used
+    for keying compiled functions on disk. Covers the bytecode of the
+    function and of functions it refers to via closures or globals.
+    """
+    seen = set() if seen is None else seen
+    if not hasattr(f, 'func_code') or f in seen:
+        return getattr(f, '__name__', type(f).__name__)
+    seen.add(f)
+    key = [marshal.dumps(f.func_code)]
+    refs = [c.cell_contents for c in f.func_closure or []]
+    refs += [f.func_globals[n] for n in f.func_code.co_names
+             if n in f.func_globals]
+    for r in refs:
+        if callable(r):
+            key += [code_key(r, seen)]
+        elif isinstance(r, LayerBase):
+            key += [r.name]
+        elif isinstance(r, (int, float, str, tuple)):
+            key += [repr(r)]
+    return '|'.join(key)
+
+
+def lerp(old, new, min_tau=0.0, en=None, ops=TheanoOps):
     """
     Return new interpolated value and a relative difference
     """
-    diff = T.mean(T.sqr(new) - T.sqr(old), axis=1, keepdims=True)
-    rel_diff = diff / (T.mean(T.sqr(old), axis=1, keepdims=True) + 1e-5)
+    diff = ops.mean(ops.sqr(new) - ops.sqr(old), axis=1, keepdims=True)
+    rel_diff = diff / (ops.mean(ops.sqr(old), axis=1, keepdims=True) + 1e-5)
     t = rel_diff * 20.
-    t = T.where(t < 5, 5, t)
-    t = T.where(t > 100, 100, t)
+    t = ops.where(t < 5, 5, t)
+    t = ops.where(t > 100, 100, t)
     t = t + min_tau
     if en is not None:
-        lmbd = T.diagonal(en).dimshuffle(0, 'x') * (1. / t)
+        lmbd = ops.diagonal(en)[:, None] * (1. / t)
     else:
         lmbd = 1. / t
     return ((1 - lmbd) * old + lmbd * new,
             t, rel_diff)
 
 
+class StateCache(object):
+    """
+    Converged states keyed by a fingerprint of the inputs they were
+    converged with. Signals that are given a cache start converge() from
+    the cached states when they see the same inputs again. The least
+    recently used states are evicted when their total size exceeds budget
+    bytes.
+    """
+    def __init__(self, budget=256 * 2 ** 20):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.size = 0
+
+    @staticmethod
+    def fingerprint(*arrays):
+        h = hashlib.sha1()
+        for a in arrays:
+            if a is not None:
+                a = np.ascontiguousarray(a)
+                h.update(repr((a.shape, a.dtype.str)))
+                h.update(a.data)
+        return h.hexdigest()
+
+    def get(self, key):
+        states = self.entries.pop(key, None)
+        if states is not None:
+            self.entries[key] = states
+        return states
+
+    def put(self, key, states):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= sum(v.nbytes for v in old.values())
+        self.entries[key] = states
+        self.size += sum(v.nbytes for v in states.values())
+        while self.size > self.budget and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.size -= sum(v.nbytes for v in old.values())
+
+
 class Signal(object):
     """ Object that represents any kind of state U, X, X_y, z, ...
     """
     def __init__(self, n, k, name, next, layer):
-        rng = np.random.RandomState(0)
-        self.var = theano.shared(np.float32(rng.uniform(size=(n, k))), name=name)
         self.n = n
+        self.var = theano.shared(self.initial(k), name=name)
         self.k = k
         self.name = name
         self.modulation = None
         self.next = next
         self.layer = layer
 
+    def initial(self, k):
+        """ Initial states of k samples """
+        rng = np.random.RandomState(0)
+        return np.float32(rng.uniform(size=(self.n, k)))
+
     def val(self):
         return self.var.get_value()
 
     def set_modulation(self, mod):
-        assert self.modulation is None
-        self.modulation = mod
+        """
+        Modulation is kept in a shared buffer that adaptation reads, so it
+        can be replaced with another one of the same shape at any time.
+        """
+        mod = np.asarray(mod, dtype=FLOATX)
+        if self.modulation is None:
+            self.modulation = theano.shared(mod, name=self.name + ':modulation')
+        else:
+            assert mod.shape == self.modulation.get_value(borrow=True).shape
+            self.modulation.set_value(mod, borrow=True)
+
+    def resize(self, k):
+        """
+        Continue with k samples. The first samples keep their states, new
+        samples start from the initial states and their modulation is one.
+        """
+        j = min(k, self.k)
+        x = self.initial(k)
+        x[:, :j] = self.var.get_value(borrow=True)[:, :j]
+        self.var.set_value(x, borrow=True)
+        self.k = k
+        if self.modulation is not None:
+            mod = np.ones((self.n, k), dtype=FLOATX)
+            mod[:, :j] = self.modulation.get_value(borrow=True)[:, :j]
+            self.modulation.set_value(mod, borrow=True)
 
     def variance(self):
         return np.average(np.log(np.var(self.var.get_value(), axis=1)))
@@ -67,10 +267,15 @@ class LayerBase(object):
         self.nonlin_est = lambda x: x
         self.nonlin = None
         self.merge_op = None
-        self.enabled = theano.shared(1, name='enable')
-        self.enable = lambda: self.enabled.set_value(1)
-        self.disable = lambda: self.enabled.set_value(0)
+        # Disabled layers are left out of the plans of the model
+        self.enabled = True
+        self.enable = lambda: self.set_enabled(True)
+        self.disable = lambda: self.set_enabled(False)
+        # Functions called when the layer is enabled or disabled
+        self.toggled = []
         self.persistent = False
+        # Whether propagation updates the state of this layer
+        self.updates_state = True
 
         self.E_XU = []
         self.phi = []
@@ -90,30 +295,29 @@ class LayerBase(object):
             signals.signal[key] = s
         return signals.signal[key]
 
-    def compile_prop_f(self, signals, has_input, min_tau=0.0):
-        tau_in = T.scalar('min_tau', dtype=FLOATX)
-        inputs = [tau_in]
+    def prop_expr(self, signals, input=None, min_tau=0.0, mask=None):
+        """
+        Return the new state of this layer and the largest relative change,
+        either as symbolic expressions or as arrays depending on the backend.
+        Mask is a precomputed pair (nans, has_nans) for an input that has
+        its missing values already replaced by zeros.
+        """
+        ops = signals.ops
         x = self.signal(signals)
 
         # Get estimate of the state from layer above
         estimate = self.estimate(signals)
 
         # Feedforward originates from previous layer's state or given input
-        if not has_input:
+        if input is None:
             feedforward = self.feedforward(signals)
-            has_nans = T.as_tensor_variable(0)
-            nans = 0.0
+        elif mask is not None:
+            nans, has_nans = mask
+            feedforward = input
         else:
-            input_t = T.matrix('input', dtype=FLOATX)
-            inputs += [input_t]
-            nans = T.isnan(input_t)
-            has_nans = T.any(nans)
-            feedforward = T.where(nans, 0.0, input_t)
-
-        self.info('Compiling propagation: [%6s] -> %4s <- [%6s]' %
-                  (",".join([p.name for p in self.prev] if self.prev else 'u/y'),
-                   self.name,
-                   ",".join([p.name for p in self.next] if self.next else '')))
+            nans = ops.isnan(input)
+            has_nans = ops.any(nans)
+            feedforward = ops.where(nans, 0.0, input)
 
         # Apply nonlinearity to feedforward path only
         if self.nonlin:
@@ -129,35 +333,130 @@ class LayerBase(object):
 
         # If predicting missing values, force them to zero in residual so
         # that they don't influence learning
-        new_value = ifelse(has_nans, T.where(nans, 0.0, new_value), new_value)
-
-        (new_X, t, d) = lerp(x.var, new_value, tau_in)
-        d = T.max(d)
-        updates = [(x.var, ifelse(self.enabled, new_X, x.var))]
+        if input is not None:
+            new_value = ops.ifelse(has_nans, ops.where(nans, 0.0, new_value),
+                                   new_value)
+
+        old = ops.value(x.var)
+        (new_X, t, d) = lerp(old, new_value, min_tau, ops=ops)
+        return new_X, ops.max(d)
+
+    def compile_prop_f(self, signals, has_input, min_tau=0.0, bound=False):
+        """
+        With bound=True the input is read from the buffers set by
+        Signals.bind_input() instead of being given to the function.
+        """
+        x = self.signal(signals)
 
-        return theano.function(inputs=inputs,
-                               outputs=d,
-                               updates=updates)
+        if not self.updates_state:
+            return lambda min_tau: 0.0
+
+        if signals.ops is NumpyOps:
+            def prop_f(min_tau, input=None):
+                mask = None
+                if bound:
+                    input, nans, has_nans = [v.get_value(borrow=True)
+                                             for v in signals.inputs[self.name]]
+                    mask = (nans, has_nans)
+                elif input is not None:
+                    input = np.asarray(input, dtype=FLOATX)
+                new_X, d = self.prop_expr(signals, input, np.float32(min_tau),
+                                          mask)
+                signals.write(x.var, new_X)
+                return d
+            return prop_f
+
+        def build():
+            self.info('Compiling propagation: [%6s] -> %4s <- [%6s]' %
+                      (",".join([p.name for p in self.prev] if self.prev else 'u/y'),
+                       self.name,
+                       ",".join([p.name for p in self.next] if self.next else '')))
+            tau_in = T.scalar('min_tau', dtype=FLOATX)
+            inputs = [tau_in]
+            input_t, mask = None, None
+            if bound:
+                input_t, nans, has_nans = signals.inputs[self.name]
+                mask = (nans, has_nans)
+            elif has_input:
+                input_t = T.matrix('input', dtype=FLOATX)
+                inputs += [input_t]
+            new_X, d = self.prop_expr(signals, input_t, tau_in, mask)
+            outputs = on_device([new_X], [x.var]) + [d]
+            keys, givens = state_inputs(signals, outputs)
+            f = theano.function(inputs=inputs + [g for (_, g) in givens],
+                                outputs=outputs,
+                                givens=givens)
+            return f, keys
+
+        key = ('prop', self.name, 'bound' if bound else has_input)
+        f, keys = signals.mdl.compiled(key, build)
+        return signals.bind(f, keys, [self.signal_key])
 
     def estimate(self, signals):
         """ Ask the next for feedback and apply nonlinearity """
-        if self.next == []:
+        fb = [n.feedback(signals, self) for n in self.next if n.enabled]
+        if fb == []:
             return 0.0
-        fb = [n.feedback(signals, self) for n in self.next]
-        return self.nonlin_est(T.sum(fb, axis=0))
+        # Added pairwise, stacking them first would make a 3-D temporary
+        return self.nonlin_est(sum(fb[1:], fb[0]))
 
     def feedback(self, signals, to):
-        phi = self.phi[self.prev.index(to)]
-        x = T.dot(phi, self.signal(signals).var)
-        return ifelse(self.enabled, x, T.zeros_like(x))
+        ops = signals.ops
+        i = self.prev.index(to)
+        return self.phi_dot(ops, i, ops.value(self.signal(signals).var))
 
     def feedforward(self, signals):
-        xs = []
-        for i, p in enumerate(self.prev):
-            sig = p.signal(signals).var
-            xs += [T.dot(self.phi[i].T, sig)]
-        x = T.sum(xs, axis=0)
-        return ifelse(self.enabled, x, T.zeros_like(x))
+        return self.phi_t_dot(signals.ops, self.prev_states(signals))
+
+    def prev_states(self, signals):
+        """ States of all previous layers stacked in the order of phi """
+        ops = signals.ops
+        xs = [ops.value(p.signal(signals).var) for p in self.prev]
+        return xs[0] if len(xs) == 1 else ops.concatenate(xs, axis=0)
+
+    def block(self, i):
+        """
+        Phi of all previous layers is kept in a single matrix so that the
+        feedforward is a single product. Return the rows of it that belong
+        to i'th previous layer.
+        """
+        start = sum(self.m[:i])
+        return slice(start, start + self.m[i])
+
+    def phi_dot(self, ops, i, x):
+        """ Product of phi for i'th previous layer and x """
+        return ops.dot(self.phi_expr(ops, i), x)
+
+    def phi_t_dot(self, ops, x):
+        """ Product of transposed phi and stacked states of previous layers """
+        return ops.dot(ops.value(self.phi[0]).T, x)
+
+    def phi_expr(self, ops, i=0):
+        """ Phi for i'th previous layer """
+        return ops.value(self.phi[0])[self.block(i)]
+
+    def get_phi(self, i=0):
+        return np.array(self.phi_expr(NumpyOps, i))
+
+    def set_enabled(self, enabled):
+        if enabled != self.enabled:
+            self.enabled = enabled
+            for f in self.toggled:
+                f()
+
+    def params(self):
+        """ Shared variables of this layer in a fixed order """
+        return self.E_XU + self.phi
+
+    def signature(self):
+        """ Description of the layer configuration for keying compiled functions """
+        attrs = sorted(vars(self).items())
+        return (type(self).__name__,
+                self.n, self.signal_key,
+                [p.name for p in self.prev], [n.name for n in self.next],
+                [(k, code_key(v)) for k, v in attrs if callable(v)],
+                [(k, v) for k, v in attrs
+                 if isinstance(v, (int, float, bool, tuple))])
 
     def info(self, str):
         if DEBUG_INFO:
@@ -165,7 +464,16 @@ class LayerBase(object):
 
 
 class Layer(LayerBase):
-    def __init__(self, name, n, prev, nonlin, min_tau=0.0, stiffx=1.0):
+    def __init__(self, name, n, prev, nonlin, min_tau=0.0, stiffx=1.0,
+                 diag_stats=False, store_phi=True):
+        """
+        With diag_stats=True only the diagonal of E_XX is tracked, as that
+        is all Q needs, and Q is kept as a column vector that scales rows.
+        E_XX and Q then have shape (n, 1) instead of (n, n).
+
+        With store_phi=False phi = (Q E_XU)^T is not stored but applied
+        as E_XU scaled with the diagonal of Q whenever it is needed.
+        """
         assert prev is not None
         if type(prev) is not list:
             prev = [prev]
@@ -174,54 +482,148 @@ class Layer(LayerBase):
         rng = np.random.RandomState(0)
         self.nonlin = nonlin
         self.stiffx = stiffx
+        self.diag_stats = diag_stats
+        self.store_phi = store_phi
         self.min_tau = theano.shared(np.float32(min_tau))
 
-        for p in prev:
-            m = p.n
-            rand_init = np.float32(rng.uniform(size=(n, m)) - 0.5)
-            self.E_XU += [theano.shared(rand_init, name='E_' + name + p.name)]
-            self.phi += [theano.shared(rand_init.T, name='phi' + name)]
-        self.Q = theano.shared(np.identity(n, dtype=FLOATX), name='Q' + name)
-        self.E_XX = theano.shared(np.identity(n, dtype=FLOATX), name='E_' + name * 2)
-
-    def compile_adapt_f(self, signals):
+        # Statistics and phi of all previous layers are concatenated
+        n, m = self.stats_dims()
+        rand_init = np.hstack([np.float32(rng.uniform(size=(n, mi)) - 0.5)
+                               for mi in m])
+        prev_names = ''.join(p.name for p in prev)
+        self.E_XU = [theano.shared(rand_init, name='E_' + name + prev_names)]
+        if store_phi:
+            self.phi = [theano.shared(rand_init.T, name='phi' + name)]
+        if diag_stats:
+            ones = np.ones((n, 1), dtype=FLOATX)
+            self.Q = theano.shared(ones, name='Q' + name,
+                                   broadcastable=(False, True))
+            self.E_XX = theano.shared(ones, name='E_' + name * 2,
+                                      broadcastable=(False, True))
+        else:
+            self.Q = theano.shared(np.identity(n, dtype=FLOATX), name='Q' + name)
+            self.E_XX = theano.shared(np.identity(n, dtype=FLOATX), name='E_' + name * 2)
+
+    def params(self):
+        return (super(Layer, self).params() +
+                [self.min_tau, self.Q, self.E_XX])
+
+    def stats_dims(self):
+        """ Number of units and inputs from each previous layer in E_XU """
+        return self.n, self.m
+
+    def moments(self, ops, x, u):
+        """
+        Second moments of the state x with itself, only the diagonal if
+        diag_stats, and with the stacked states u of the previous layers
+        """
+        # Compiled functions are shared between signals of any k
+        k = ops.cast(x.shape[1], FLOATX)
+        if self.diag_stats:
+            E_XX = ops.mean(ops.sqr(x), axis=1, keepdims=True)
+        else:
+            E_XX = ops.dot(x, x.T) / k
+        return E_XX, ops.dot(x, u.T) / k
+
+    def q(self):
+        """ Diagonal of Q as a vector """
+        Q = self.Q.get_value()
+        return Q[:, 0] if self.diag_stats else np.diagonal(Q)
+
+    def q_column(self, ops):
+        Q = ops.value(self.Q)
+        return Q if self.diag_stats else ops.diagonal(Q)[:, None]
+
+    def phi_dot(self, ops, i, x):
+        if self.store_phi:
+            return super(Layer, self).phi_dot(ops, i, x)
+        E_XU = ops.value(self.E_XU[0])[:, self.block(i)]
+        return ops.dot(E_XU.T, self.q_column(ops) * x)
+
+    def phi_t_dot(self, ops, x):
+        if self.store_phi:
+            return super(Layer, self).phi_t_dot(ops, x)
+        return self.q_column(ops) * ops.dot(ops.value(self.E_XU[0]), x)
+
+    def phi_expr(self, ops, i=0):
+        if self.store_phi:
+            return super(Layer, self).phi_expr(ops, i)
+        return (self.q_column(ops) * ops.value(self.E_XU[0])[:, self.block(i)]).T
+
+    def adapt_expr(self, signals, stiff):
+        """
+        Return a list of (parameter, new value) pairs and the largest
+        relative change of the statistics
+        """
+        ops = signals.ops
         x = self.signal(signals)
         x_prev = [p.signal(signals) for p in self.prev]
         assert np.all([x.k == xp.k for xp in x_prev])
         assert self.m == [xp.n for xp in x_prev]
         assert x.n == self.n
-        k = np.float32(x.k)
+        min_tau = ops.value(self.min_tau)
         # Modulate x
+        x_ = ops.value(x.var)
         if x.modulation is not None:
-            x_ = x.var * T.as_tensor_variable(x.modulation)
-        else:
-            x_ = x.var
+            x_ = x_ * ops.value(x.modulation)
 
         updates = []
-        upd = lambda en, old, new: [(old, ifelse(en, new, old))]
-
-        E_XX_new, _, d = lerp(self.E_XX, T.dot(x_, x_.T) / k, self.min_tau)
-        updates += upd(self.enabled, self.E_XX, E_XX_new)
+        E_XX_x, E_XU_x = self.moments(ops, x_, self.prev_states(signals))
+        E_XX_new, _, d = lerp(ops.value(self.E_XX), E_XX_x, min_tau, ops=ops)
+        updates += [(self.E_XX, E_XX_new)]
         b = 1.
-        d = T.diagonal(E_XX_new)
-        stiff = T.scalar('stiffnes', dtype=FLOATX)
-        Q_new = theano_diag(b / T.where(d < stiff * self.stiffx,
-                                        stiff * self.stiffx, d))
-        updates += upd(self.enabled, self.Q, Q_new)
-
-        for i, x_p in enumerate(x_prev):
-            E_XU_new, _, d_ = lerp(self.E_XU[i], T.dot(x_, x_p.var.T) / k,
-                                   self.min_tau)
-            updates += upd(self.enabled, self.E_XU[i], E_XU_new)
-            d = T.maximum(d, d_)
-            updates += upd(self.enabled, self.phi[i], T.dot(Q_new, E_XU_new).T)
-
-        self.info('Compile layer update between: ' + self.name + ' and '
-                  + ', '.join([p.name for p in self.prev]))
-        return theano.function(
-            inputs=[stiff],
-            outputs=d,
-            updates=updates)
+        e = E_XX_new if self.diag_stats else ops.diagonal(E_XX_new)
+        q = b / ops.where(e < stiff * self.stiffx, stiff * self.stiffx, e)
+        Q_new = q if self.diag_stats else ops.diag(q)
+        updates += [(self.Q, Q_new)]
+
+        # Statistics of all previous layers come from a single product, but
+        # lerp estimates the time constant for each of them separately
+        E_XU = ops.value(self.E_XU[0])
+        E_XU_new = []
+        for i in range(len(x_prev)):
+            b = self.block(i)
+            new, _, d_ = lerp(E_XU[:, b], E_XU_x[:, b], min_tau, ops=ops)
+            E_XU_new += [new]
+            d = ops.maximum(d, d_)
+        if len(E_XU_new) == 1:
+            E_XU_new = E_XU_new[0]
+        else:
+            E_XU_new = ops.concatenate(E_XU_new, axis=1)
+        updates += [(self.E_XU[0], E_XU_new)]
+        if self.store_phi and self.diag_stats:
+            updates += [(self.phi[0], (Q_new * E_XU_new).T)]
+        elif self.store_phi:
+            updates += [(self.phi[0], ops.dot(Q_new, E_XU_new).T)]
+        return updates, ops.max(d)
+
+    def compile_adapt_f(self, signals):
+        if signals.ops is NumpyOps:
+            def adapt_f(stiff):
+                updates, d = self.adapt_expr(signals, np.float32(stiff))
+                for (old, new) in updates:
+                    old.set_value(new, borrow=True)
+                return d
+            return adapt_f
+
+        modulated = self.signal(signals).modulation is not None
+
+        def build():
+            self.info('Compile layer update between: ' + self.name + ' and '
+                      + ', '.join([p.name for p in self.prev]))
+            stiff = T.scalar('stiffnes', dtype=FLOATX)
+            inputs = [stiff]
+            updates, d = self.adapt_expr(signals, stiff)
+            keys, givens = state_inputs(signals, [d] + [u for (_, u) in updates])
+            f = theano.function(
+                inputs=inputs + [g for (_, g) in givens],
+                outputs=[d],
+                updates=updates,
+                givens=givens)
+            return f, keys
+
+        f, keys = signals.mdl.compiled(('adapt', self.name, modulated), build)
+        return signals.bind(f, keys, [])
 
     def __str__(self):
         return "Layer %3s (%d) %.2f, %.2f, %s" % (self.name, self.n,
@@ -230,6 +632,99 @@ class Layer(LayerBase):
                                                   self.nonlin)
 
 
+class ConvLayer(Layer):
+    def __init__(self, name, filters, w, prev, nonlin, shape=None, min_tau=0.0,
+                 stiffx=1.0, diag_stats=False, store_phi=True):
+        """
+        Layer of w x w filters shared over all positions of the images of
+        prev, which are flattened from shape (height, width, channels).
+        Shape can be left out if prev is a ConvLayer. The state has shape
+        (height - w + 1, width - w + 1, filters) flattened the same way.
+        Phi is the filter bank of shape (w * w * channels, filters), and
+        E_XX and E_XU are averaged over positions as well as samples.
+        """
+        if type(prev) is list:
+            assert len(prev) == 1, 'ConvLayer has a single previous layer'
+            prev = prev[0]
+        shape = getattr(prev, 'shape', shape)
+        assert shape is not None and np.prod(shape) == prev.n, 'Shape mismatch'
+        self.in_shape = shape
+        self.w = w
+        self.filters = filters
+        self.shape = (shape[0] - w + 1, shape[1] - w + 1, filters)
+        super(ConvLayer, self).__init__(name, int(np.prod(self.shape)), prev,
+                                        nonlin, min_tau, stiffx, diag_stats,
+                                        store_phi)
+
+    def stats_dims(self):
+        return self.filters, [self.w * self.w * self.in_shape[2]]
+
+    def block(self, i):
+        return slice(0, self.stats_dims()[1][0])
+
+    def offsets(self):
+        """ Positions of the filter taps in the order of the rows of phi """
+        return [(dx, dy) for dx in range(self.w) for dy in range(self.w)]
+
+    def images(self, x, shape):
+        """ Flattened states as images with channels first """
+        return x.reshape(shape + (-1,)).transpose(2, 0, 1, 3)
+
+    def flatten(self, x):
+        """ Images with channels first back to flattened states """
+        return x.transpose(1, 2, 0, 3).reshape((-1, x.shape[3]))
+
+    def phi_t_dot(self, ops, u):
+        """
+        Correlation of the images with the filters as a sum of one product
+        per filter tap, which avoids building all patches at once
+        """
+        h, w, f = self.shape
+        c = self.in_shape[2]
+        u = self.images(u, self.in_shape)
+        phi = self.phi_expr(ops)
+        x = sum([ops.dot(phi[o * c:(o + 1) * c].T,
+                         u[:, dx:dx + h, dy:dy + w].reshape((c, -1)))
+                 for o, (dx, dy) in enumerate(self.offsets())])
+        return self.flatten(x.reshape((f, h, w, -1)))
+
+    def phi_dot(self, ops, i, x):
+        """ Transposed convolution, the same taps over zero padded states """
+        height, width, c = self.in_shape
+        f, p = self.filters, self.w - 1
+        x = self.images(x, self.shape)
+        zeros = ops.zeros_like(x[:, :1])
+        x = ops.concatenate([zeros] * p + [x] + [zeros] * p, axis=1)
+        zeros = ops.zeros_like(x[:, :, :1])
+        x = ops.concatenate([zeros] * p + [x] + [zeros] * p, axis=2)
+        phi = self.phi_expr(ops)
+        u = sum([ops.dot(phi[o * c:(o + 1) * c],
+                         x[:, p - dx:p - dx + height,
+                           p - dy:p - dy + width].reshape((f, -1)))
+                 for o, (dx, dy) in enumerate(self.offsets())])
+        return self.flatten(u.reshape((c, height, width, -1)))
+
+    def moments(self, ops, x, u):
+        h, w, f = self.shape
+        c = self.in_shape[2]
+        x = self.images(x, self.shape).reshape((f, -1))
+        u = self.images(u, self.in_shape)
+        # Positions count as samples
+        k = ops.cast(x.shape[1], FLOATX)
+        if self.diag_stats:
+            E_XX = ops.mean(ops.sqr(x), axis=1, keepdims=True)
+        else:
+            E_XX = ops.dot(x, x.T) / k
+        E_XU = ops.concatenate(
+            [ops.dot(x, u[:, dx:dx + h, dy:dy + w].reshape((c, -1)).T)
+             for (dx, dy) in self.offsets()], axis=1) / k
+        return E_XX, E_XU
+
+    def __str__(self):
+        return "ConvLayer %3s (%s) %dx%d" % (self.name, self.shape,
+                                            self.w, self.w)
+
+
 class Input(LayerBase):
     def __init__(self, name, n, persistent=False):
         super(Input, self).__init__(name, n, [])
@@ -238,6 +733,9 @@ class Input(LayerBase):
     def compile_adapt_f(self, signals):
         return lambda stiff: 0.0
 
+    def adapt_expr(self, signals, stiff):
+        return [], 0.0
+
     def __str__(self):
         return "Input %3s (%d)" % (self.name, self.n)
 
@@ -266,7 +764,7 @@ class RegressionLayer(LayerBase):
             self.u_side.merge_op = merge_op
 
         # Disable state updates on the y side so that X is updated only once
-        self.y_side.compile_prop_f = lambda s, is_input: lambda min_tau: 0.0
+        self.y_side.updates_state = False
 
     def compile_adapt_f(self, signals):
         assert False, "should not be called"
@@ -353,39 +851,172 @@ class ECA(object):
     def __init__(self):
         self.U = None
         self.Y = None
+        # Compiled functions shared by all signals of this model
+        self.functions = {}
+        self.plans = {}
         self.structure()
         assert self.U is not None
-        # TODO: Add more checks for layer structure, e.g. avoid loops
-        for l in self.iter_layers():
+        self.layers = self.topological()
+        for l in self.layers:
+            l.toggled += [self.replan]
             print l
+        self.replan()
 
     def structure(self):
         raise NotImplemented
 
-    def iter_layers(self, skip_inputs=False):
-        def recurse(l):
-            if not l:
-                return
-            yield l
+    def topological(self):
+        """
+        Return the layers reachable from the inputs so that each layer comes
+        after all of its previous layers. Ties are resolved in the order
+        the layers were connected, so the result does not vary between runs.
+        """
+        inputs = [l for l in [self.U, self.Y] if l]
+        reachable, stack = [], list(reversed(inputs))
+        while stack:
+            l = stack.pop()
+            if l not in reachable:
+                reachable += [l]
+                stack += reversed(l.next)
+        waiting = dict((l, len([p for p in l.prev if p in reachable]))
+                       for l in reachable)
+        order, ready = [], list(inputs)
+        while ready:
+            l = ready.pop(0)
+            order += [l]
             for n in l.next:
-                for x in recurse(n):
-                    yield x
+                waiting[n] -= 1
+                if waiting[n] == 0:
+                    ready += [n]
+        assert len(order) == len(reachable), 'layers must not form loops'
+        return order
+
+    def plan(self, order='bottom-up'):
+        """
+        Return the layers in the order they are updated in:
+          bottom-up: from the inputs towards the top, each layer sees the
+                     states its previous layers got in the same iteration
+          top-down:  from the top towards the inputs
+          jacobi:    all layers are updated simultaneously from the states
+                     of the previous iteration
+        """
+        assert order in ORDERS, 'unknown order ' + order
+        if order not in self.plans:
+            layers = [l for l in self.layers if l.enabled]
+            self.plans[order] = layers[::-1] if order == 'top-down' else layers
+        return self.plans[order]
+
+    def replan(self):
+        """
+        Drop the plans after a layer has been enabled or disabled. Disabled
+        layers change the graphs of their neighbours, so they are part of
+        the keys of compiled functions.
+        """
+        self.plans = {}
+        self.disabled = tuple(l.name for l in self.layers if not l.enabled)
 
-        s = set(list(recurse(self.U)) + list(recurse(self.Y)))
+    def iter_layers(self, skip_inputs=False):
         if skip_inputs:
-            s -= set([self.U, self.Y])
-        return s
-
-    def new_signals(self, k):
-        return Signals(k, self)
+            return [l for l in self.layers if l not in (self.U, self.Y)]
+        return self.layers
+
+    def new_signals(self, k, **kwargs):
+        return Signals(k, self, **kwargs)
+
+    def compiled(self, key, build):
+        """
+        Return compiled function and the signal keys it takes as arguments.
+        Functions do not depend on k nor the signals instance, so build() is
+        called only once per model, or never if FUNCTION_CACHE_DIR has it.
+        """
+        key += (self.disabled,)
+        if key not in self.functions:
+            f = self.load_function(key) if FUNCTION_CACHE_DIR else None
+            if f is None:
+                f = build()
+                if FUNCTION_CACHE_DIR:
+                    self.store_function(key, f)
+            self.functions[key] = f
+        return self.functions[key]
+
+    def params(self):
+        layers = sorted(self.iter_layers(), key=lambda l: l.name)
+        return sum([l.params() for l in layers], [])
+
+    def function_path(self, key):
+        layers = sorted(self.iter_layers(), key=lambda l: l.name)
+        sig = [l.signature() for l in layers]
+        src = open(__file__.rstrip('c')).read()
+        env = (theano.__version__, theano.config.device, FLOATX)
+        h = hashlib.sha1(repr((key, sig, env, src))).hexdigest()
+        return os.path.join(FUNCTION_CACHE_DIR, h + '.pkl')
+
+    def store_function(self, key, compiled):
+        """
+        Store the function graph, the model parameters are stored as indices
+        so that they can be replaced by the parameters of another instance.
+        The signal keys that follow the function are stored as such.
+        """
+        f, keys = compiled[0], compiled[1:]
+        params = self.params()
+        idx = [params.index(i.variable) if i.shared else None
+               for i in f.maker.inputs]
+        if not os.path.exists(FUNCTION_CACHE_DIR):
+            os.makedirs(FUNCTION_CACHE_DIR)
+        path = self.function_path(key)
+        fd, tmp = tempfile.mkstemp(dir=FUNCTION_CACHE_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                cPickle.dump((f.maker, idx, keys), fp, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except (RuntimeError, cPickle.PicklingError):
+            # Graphs of scan loops are too deep to pickle, those functions
+            # are compiled again in every run
+            pass
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def load_function(self, key):
+        path = self.function_path(key)
+        if not os.path.exists(path):
+            return None
+        reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        try:
+            with open(path, 'rb') as fp:
+                maker, idx, keys = cPickle.load(fp)
+        finally:
+            theano.config.reoptimize_unpickled_function = reoptimize
+        params = self.params()
+        storage = [params[i].container if i is not None else None for i in idx]
+        return (maker.create(storage),) + keys
 
     def first_phi(self):
         # index is omitted for now, and the lowest layer is plotted
-        return self.U.next[0].phi[0].get_value()
-
-    def phi_norms(self):
-        f = lambda l: (l.name, (np.linalg.norm(l.phi[0].get_value(), axis=0)))
-        return map(f, self.iter_layers(skip_inputs=True))
+        return self.U.next[0].get_phi()
+
+    def phi_norms_expr(self, ops):
+        """ Names of the layers and the norms of the columns of their phi """
+        layers = sorted(self.iter_layers(skip_inputs=True), key=lambda l: l.name)
+        norm = lambda phi: ops.sqrt(ops.sum(ops.sqr(phi), axis=0))
+        return ([l.name for l in layers],
+                [norm(l.phi_expr(ops)) for l in layers])
+
+    def phi_norms(self, ops=None):
+        """
+        Names of the layers and the norms of the columns of their phi, with
+        the ops of the default backend unless given. Only theano compiles.
+        """
+        ops = ops or BACKENDS[BACKEND]
+        if ops is NumpyOps:
+            return zip(*self.phi_norms_expr(NumpyOps))
+
+        def build():
+            names, norms = self.phi_norms_expr(TheanoOps)
+            return theano.function([], norms), names
+        f, names = self.compiled(('phi_norms',), build)
+        return zip(names, f())
 
 
 class SimpleECA(ECA):
@@ -401,91 +1032,641 @@ class SimpleECA(ECA):
 
 
 class Signals(object):
-    def __init__(self, k, eca):
+    def __init__(self, k, eca, backend=None, fused=False, scan=False,
+                 order='bottom-up', threads=0, cache=None):
+        """
+        With fused=True the whole network is propagated with a single
+        compiled function instead of one function per layer. With scan=True
+        also converge() iterates inside a single compiled loop. Order is
+        the layer update order, see ECA.plan(). In jacobi order the layers
+        are independent and can be propagated by a pool of threads, which
+        pays off mostly with the numpy backend as its BLAS releases the GIL.
+        With a StateCache converge() warm starts from the states it reached
+        the last time with the same inputs.
+        """
         self.mdl = eca
         self.k = k
+        self.order = order
+        self.cache = cache
+        self.plan = None
+        self.backend = backend or BACKEND
+        assert self.backend in BACKENDS, 'unknown backend ' + self.backend
+        self.ops = BACKENDS[self.backend]
+        # Numpy backend has no dispatch overhead to get rid of
+        self.fused = (fused or scan) and self.ops is TheanoOps
+        self.scan = scan and self.ops is TheanoOps
+        # States written during a jacobi step, None outside of one
+        self.back = None
+        self.pool = thread_pool(threads) if threads and order == 'jacobi' else None
         self.adaptf = {}
+        self.modulated = []
         self.propf = {}
+        self.fusedf = None
+        self.convergef = None
+        self.trainf = {}
+        self.exprf = {}
+        # Input buffers per input layer and the arrays bound to them
+        self.inputs = {}
+        self.bound = None
+        self.boundf = None
+        # Iterations and final delta of the latest converge()
+        self.iters, self.delta = 0, np.inf
         self.signal = {}
         self.name = None
         print 'Creating signals with k =', k
 
-        for l in eca.iter_layers():
-            is_input = l is eca.U or l is eca.Y
-            self.propf[l.name] = l.compile_prop_f(self, is_input)
+        # Create all signals first, compiled functions may refer to any
+        for l in eca.layers:
+            l.signal(self)
         self.U = self.signal[eca.U.name]
         self.Y = self.signal[eca.Y.name] if eca.Y else None
+        self.update_plan()
+
+    def update_plan(self):
+        """
+        Take the current plan of the model and the functions for it, which
+        are compiled only once for each set of disabled layers
+        """
+        plan = self.mdl.plan(self.order)
+        if plan is self.plan:
+            return
+        self.plan = plan
+        self.adaptf, self.propf, self.exprf = {}, {}, {}
+        self.fusedf = self.convergef = self.boundf = None
+        self.trainf = {}
+        if self.fused:
+            self.fusedf = self.compile_fused_prop_f()
+        if self.scan:
+            self.convergef = self.compile_converge_f()
+        else:
+            for l in self.plan:
+                is_input = l is self.mdl.U or l is self.mdl.Y
+                self.propf[l.name] = l.compile_prop_f(self, is_input)
+
+    def buffers(self):
+        """ Shared variables that compiled functions take as inputs by key """
+        b = dict((k, s.var) for k, s in self.signal.items())
+        b.update((s.modulation.name, s.modulation)
+                 for s in self.signal.values() if s.modulation is not None)
+        for vars in self.inputs.values():
+            b.update((v.name, v) for v in vars)
+        return b
+
+    def bind(self, f, keys, outputs):
+        """
+        Bind a compiled function that takes the states of signals with given
+        keys as its last arguments to the states of this instance. The first
+        results are written back to the states of the outputs and the rest
+        are returned.
+        """
+        buffers = self.buffers()
+        states = [buffers[k] for k in keys]
+        outputs = [self.signal[k].var for k in outputs]
+
+        def bound(*args):
+            args += tuple(s.get_value(borrow=True, return_internal_type=True)
+                          for s in states)
+            res = f(*args)
+            for var, val in zip(outputs, res):
+                self.write(var, val)
+            rest = res[len(outputs):]
+            return rest[0] if len(rest) == 1 else rest
+        return bound
+
+    def bind_input(self, u, y=None):
+        """
+        Copy the inputs and their missing value masks to shared buffers.
+        Later propagate() calls with these same arrays use the buffers and
+        do not transfer the inputs nor look for missing values again. Call
+        again if the arrays are modified in place.
+        """
+        for l, v in [(self.mdl.U, u), (self.mdl.Y, y)]:
+            if l is None:
+                continue
+            assert v is not None and v.shape == (l.n, self.k), 'Shape mismatch'
+            v = np.asarray(v, dtype=FLOATX)
+            nans = np.isnan(v)
+            values = [np.where(nans, np.float32(0.), v), np.int8(nans),
+                      np.int8(np.any(nans))]
+            if l.name in self.inputs:
+                for var, val in zip(self.inputs[l.name], values):
+                    var.set_value(val, borrow=True)
+            else:
+                names = [l.name + ':input', l.name + ':nans', l.name + ':has_nans']
+                self.inputs[l.name] = [theano.shared(val, name=n)
+                                       for val, n in zip(values, names)]
+        self.bound = (u, y)
+        return self
+
+    def resize(self, k):
+        """
+        Change the number of samples to any k. The states are reallocated
+        but nothing is compiled, as the compiled functions do not depend on
+        k. The first samples keep their states. Inputs have to be bound
+        again.
+        """
+        for s in self.signal.values():
+            s.resize(k)
+        self.k = k
+        self.bound = None
+        return self
+
+    def compile_bound_f(self):
+        """ Return a function propagating the bound inputs """
+        if self.fused:
+            return self.compile_fused_prop_f(bound=True)
+        fs = [l.compile_prop_f(self, False, bound=l.name in self.inputs)
+              for l in self.plan]
+        return lambda min_tau: self.step([(f, [min_tau]) for f in fs])
+
+    def fused_prop_expr(self, u, y, min_tau, bound=False):
+        """
+        Return new states of all layers updated in the same order as
+        propagate() does, and the largest relative change among them
+        """
+        new = OrderedDict()
+        ds = []
+        for l in self.plan:
+            if not l.updates_state:
+                continue
+            input = u if l is self.mdl.U else y if l is self.mdl.Y else None
+            mask = None
+            if bound and input is not None:
+                input, nans, has_nans = self.inputs[l.name]
+                mask = (nans, has_nans)
+            new_X, d = l.prop_expr(self, input, min_tau, mask)
+            # Layers later in the order see the already updated states
+            if self.order != 'jacobi':
+                new_X, d = theano.clone([new_X, d], replace=new)
+            new[l.signal(self).var] = new_X
+            ds += [d]
+        return new, T.max(T.stack(*ds))
+
+    def compile_fused_prop_f(self, bound=False):
+        order = (self.order,) + tuple(l.name for l in self.plan)
+
+        def build():
+            tau_in = T.scalar('min_tau', dtype=FLOATX)
+            u_t = T.matrix('u', dtype=FLOATX)
+            y_t = T.matrix('y', dtype=FLOATX) if self.mdl.Y else None
+            inputs = [tau_in]
+            if not bound:
+                inputs += [u_t] + ([y_t] if y_t else [])
+            new, d = self.fused_prop_expr(u_t, y_t, tau_in, bound)
+            outputs = on_device(new.values(), new.keys()) + [d]
+            keys, givens = state_inputs(self, outputs)
+            f = theano.function(inputs=inputs + [g for (_, g) in givens],
+                                outputs=outputs,
+                                givens=givens)
+            key_of = dict((s.var, k) for k, s in self.signal.items())
+            return f, keys, [key_of[v] for v in new.keys()]
+
+        f, keys, out = self.mdl.compiled(('fused', order, bound), build)
+        return self.bind(f, keys, out)
+
+    def compile_converge_f(self):
+        order = (self.order,) + tuple(l.name for l in self.plan)
+
+        def build():
+            tau_in = T.scalar('min_tau', dtype=FLOATX)
+            u_t = T.matrix('u', dtype=FLOATX)
+            y_t = T.matrix('y', dtype=FLOATX) if self.mdl.Y else None
+            d_limit = T.scalar('d_limit', dtype=FLOATX)
+            i_limit = T.iscalar('i_limit')
+            inputs = [tau_in, u_t] + ([y_t] if y_t else []) + [d_limit, i_limit]
+            new, d = self.fused_prop_expr(u_t, y_t, tau_in)
+            state_vars = new.keys()
+
+            def step(*args):
+                states, limit = args[:-1], args[-1]
+                outs = theano.clone(new.values() + [d],
+                                    replace=dict(zip(state_vars, states)))
+                return outs, theano.scan_module.until(outs[-1] <= limit)
+
+            outs, _ = theano.scan(step, outputs_info=state_vars + [None],
+                                  non_sequences=[d_limit], n_steps=i_limit)
+            outputs = on_device([o[-1] for o in outs[:-1]], state_vars)
+            outputs += [outs[-1].shape[0], outs[-1][-1]]
+            keys, givens = state_inputs(self, outputs)
+            f = theano.function(inputs=inputs + [g for (_, g) in givens],
+                                outputs=outputs,
+                                givens=givens)
+            key_of = dict((s.var, k) for k, s in self.signal.items())
+            return f, keys, [key_of[v] for v in state_vars]
+
+        f, keys, out = self.mdl.compiled(('converge', order), build)
+        return self.bind(f, keys, out)
+
+    def compile_train_f(self, bound=False):
+        order = (self.order,) + tuple(l.name for l in self.plan)
+        modulated = tuple(sorted(k for k, s in self.signal.items()
+                                 if s.modulation is not None))
+
+        def build():
+            stiff, tau = T.scalars('stiff', 'min_tau')
+            schedule = T.scalars('stiff_end', 'stiff_decay',
+                                 'tau_end', 'tau_decay')
+            u_t = T.matrix('u', dtype=FLOATX)
+            y_t = T.matrix('y', dtype=FLOATX) if self.mdl.Y else None
+            n_iters = T.iscalar('n_iters')
+            inputs = [stiff, tau] + schedule + [n_iters]
+            if not bound:
+                inputs += [u_t] + ([y_t] if y_t else [])
+            new, _ = self.fused_prop_expr(u_t, y_t, tau, bound)
+            # Adaptation sees the states of the same step
+            updates, ds = [], []
+            for l in self.plan:
+                layer_updates, d = l.adapt_expr(self, stiff)
+                if layer_updates:
+                    updates += layer_updates
+                    ds += [d]
+            new_params = theano.clone([v for (_, v) in updates] + ds,
+                                      replace=new)
+            state_vars, params = new.keys(), [p for (p, _) in updates]
+            outs = new.values() + new_params[:len(params)]
+            d = T.max(T.stack(*new_params[len(params):]))
+            carried = state_vars + params
+
+            def step(*args):
+                s, t = args[:2]
+                values = args[2:2 + len(carried)]
+                s_end, s_decay, t_end, t_decay = args[2 + len(carried):]
+                values = [T.patternbroadcast(x, v.broadcastable)
+                          for x, v in zip(values, carried)]
+                replace = dict(zip(carried, values) + [(stiff, s), (tau, t)])
+                res = theano.clone(outs + [d], replace=replace)
+                res = [unbroadcast(r) for r in res[:-1]] + res[-1:]
+                return ([s * s_decay + (1 - s_decay) * s_end,
+                         t * t_decay + (1 - t_decay) * t_end] + res)
+
+            # Scan fails on broadcastable columns such as diagonal E_XX
+            unbroadcast = lambda v: T.unbroadcast(v, *range(v.ndim))
+            init = [stiff, tau] + map(unbroadcast, carried) + [None]
+            res, _ = theano.scan(step, n_steps=n_iters, outputs_info=init,
+                                 non_sequences=schedule)
+            last = [T.patternbroadcast(r[-1], v.broadcastable)
+                    for r, v in zip(res[2:-1], carried)]
+            outputs = on_device(last[:len(state_vars)], state_vars)
+            outputs += [res[0][-1], res[1][-1], res[-1]]
+            keys, givens = state_inputs(self, outputs + last)
+            f = theano.function(inputs=inputs + [g for (_, g) in givens],
+                                outputs=outputs,
+                                updates=zip(params, last[len(state_vars):]),
+                                givens=givens)
+            key_of = dict((s.var, k) for k, s in self.signal.items())
+            return f, keys, [key_of[v] for v in state_vars]
+
+        f, keys, out = self.mdl.compiled(('train', order, modulated, bound),
+                                         build)
+        return self.bind(f, keys, out)
 
     def adapt_layers(self, stiffness):
-        # Compile adaptation functions lazily
-        if self.adaptf == {}:
-            for l in self.mdl.iter_layers():
+        self.update_plan()
+        # Compile adaptation functions lazily, and again only if a signal
+        # got modulated for the first time
+        modulated = [k for k, s in self.signal.items() if s.modulation is not None]
+        if self.adaptf == {} or modulated != self.modulated:
+            self.modulated = modulated
+            for l in self.plan:
                 self.adaptf[l.name] = l.compile_adapt_f(self)
 
-        for l in self.mdl.iter_layers():
-            self.adaptf[l.name](stiffness)
+        return max([0.0] + [self.adaptf[l.name](stiffness) for l in self.plan])
 
     def propagate(self, u, y, min_tau=0.0):
         assert u is None or self.k == u.shape[1], "Sample size mismatch"
         assert y is None or self.k == y.shape[1], "Sample size mismatch"
-        d = 0.0
-        for l in self.mdl.iter_layers():
+        return self.propagate_layers(u, y, min_tau)
+
+    def propagate_layers(self, u, y, min_tau=0.0):
+        """ Propagate states of any number of samples """
+        self.update_plan()
+        if self.bound is not None and self.bound[0] is u and self.bound[1] is y:
+            if self.boundf is None:
+                self.boundf = self.compile_bound_f()
+            return self.boundf(min_tau)
+        if self.fusedf:
+            return self.fusedf(min_tau, u, *([y] if self.mdl.Y else []))
+        calls = []
+        for l in self.plan:
             args = [min_tau]
             args += [u] if l is self.mdl.U else []
             args += [y] if l is self.mdl.Y else []
-            d = max(d, self.propf[l.name](*args))
-        return d
-
-    def converge(self, u, y, min_tau=0.0, d_limit=1e-3):
+            calls += [(self.propf[l.name], args)]
+        return self.step(calls)
+
+    def step(self, calls):
+        """
+        Call the propagation functions with their arguments and return the
+        largest change. In jacobi order all of them read the states of the
+        previous step, and the new states are collected to a back buffer
+        that replaces the states once all the functions have been called.
+        """
+        if self.order != 'jacobi':
+            return max([0.0] + [f(*args) for (f, args) in calls])
+        self.back = []
+        try:
+            call = lambda (f, args): f(*args)
+            ds = self.pool.map(call, calls) if self.pool else map(call, calls)
+        finally:
+            back, self.back = self.back, None
+        for var, val in back:
+            var.set_value(val, borrow=True)
+        return max([0.0] + ds)
+
+    def write(self, var, value):
+        """ Set a new state, or put it to the back buffer during a jacobi step """
+        if self.back is not None:
+            self.back.append((var, value))
+        else:
+            var.set_value(value, borrow=True)
+
+    def train_batches(self, data, stiff, stiff_update=None, type='trn',
+                      epochs=1, iters=1):
+        """
+        Stream successive minibatches of a Dataset through these signals,
+        propagating and adapting iters times per minibatch, so that the
+        statistics of the layers accumulate over the whole split. Signals
+        are resized for a partial minibatch and back to k after all. Returns
+        the final stiffness and the number of samples processed per second.
+        """
+        t = time()
+        samples, k = 0, self.k
+        for e in range(epochs):
+            for i in range(data.batches(type)):
+                d = data.get(type, i)
+                if d.k != self.k:
+                    self.resize(d.k)
+                y = d.labels if self.mdl.Y else None
+                self.bind_input(d.samples, y)
+                for j in range(iters):
+                    self.propagate(d.samples, y)
+                    self.adapt_layers(stiff)
+                    stiff = stiff_update(stiff) if stiff_update else stiff
+                samples += d.k
+        self.resize(k)
+        rate = samples / (time() - t)
+        print 'Trained on', samples, 'samples, %.0f samples/s' % rate
+        return stiff, rate
+
+    def train(self, u, y, n_iters, stiff=(0.5, 0.005, 0.99),
+              min_tau=(0.0, 0.0, 1.0)):
+        """
+        Propagate and adapt n_iters times. Stiffness and min_tau follow
+        exponential schedules given as (start, end, decay), moving as
+        s = s * decay + (1 - decay) * end after every step. With the theano
+        backend all the steps run inside one compiled loop. Returns the
+        stiffness and min_tau for the next step and the largest relative
+        change of the statistics on each step.
+        """
+        self.update_plan()
+        (s, s_end, s_decay), (t, t_end, t_decay) = stiff, min_tau
+        if self.ops is NumpyOps:
+            ds = []
+            for i in range(n_iters):
+                self.propagate(u, y, t)
+                ds += [self.adapt_layers(s)]
+                s = s * s_decay + (1 - s_decay) * s_end
+                t = t * t_decay + (1 - t_decay) * t_end
+            return s, t, np.array(ds, dtype=FLOATX)
+
+        bound = self.bound is not None and self.bound[0] is u and self.bound[1] is y
+        # Modulating a signal for the first time changes the graph
+        key = (bound,) + tuple(sorted(k for k, x in self.signal.items()
+                                      if x.modulation is not None))
+        if key not in self.trainf:
+            self.trainf[key] = self.compile_train_f(bound)
+        args = [s, t, s_end, s_decay, t_end, t_decay]
+        args = [np.float32(a) for a in args] + [n_iters]
+        if not bound:
+            args += [u] + ([y] if self.mdl.Y else [])
+        s, t, ds = self.trainf[key](*args)
+        return float(s), float(t), ds
+
+    def converge(self, u, y, min_tau=0.0, d_limit=1e-3, per_sample=False,
+                 anderson=0):
+        """
+        Propagate until the largest relative change drops below d_limit. With
+        per_sample=True convergence is decided for each sample separately,
+        see converge_samples(). Anderson > 0 accelerates the iteration with
+        Anderson mixing over that many previous steps, see
+        converge_anderson().
+        """
+        self.update_plan()
+        if self.cache is not None:
+            key = StateCache.fingerprint(u, y)
+            for k, v in (self.cache.get(key) or {}).items():
+                self.signal[k].var.set_value(v)
         t = 20
         t_limit, i_limit = time() + t, 200
         d, i, = np.inf, 0
+        if per_sample:
+            i, d = self.converge_samples(u, y, min_tau, d_limit,
+                                         t_limit, i_limit)
+        elif anderson:
+            i, d = self.converge_anderson(u, y, min_tau, d_limit,
+                                          t_limit, i_limit, anderson)
+        elif self.convergef:
+            # Time limit cannot be checked inside the compiled loop
+            args = [min_tau, u] + ([y] if self.mdl.Y else [])
+            i, d = self.convergef(*(args + [d_limit, i_limit]))
         while d > d_limit and time() < t_limit and i < i_limit:
             d = self.propagate(u, y, min_tau)
             i += 1
+        self.iters, self.delta = int(i), float(d)
+        if self.cache is not None:
+            self.cache.put(key, dict((k, s.val()) for k, s in self.signal.items()))
         if PRINT_CONVERGENCE:
             print 'Converged in', "%.1f" % (time() - t_limit + t), 's,',
             print i, 'iters, delta %.4f' % d,
             print 'Limits: i:', i_limit, 't:', t, 'd:', d_limit
         return self
 
+    def converge_anderson(self, u, y, min_tau, d_limit, t_limit, i_limit, m):
+        """
+        Treat propagation as a map g from the states of all layers to new
+        states, and instead of taking g(x) as the next states, combine the
+        latest m steps so that the residual g(x) - x is minimized. This is
+        done for each sample separately. The history is dropped whenever
+        the residual grows. Returns iterations taken and the final delta.
+        """
+        vars = [s.var for (_, s) in sorted(self.signal.items())]
+        rows = np.cumsum([0] + [v.get_value(borrow=True).shape[0] for v in vars])
+        stack = lambda: np.vstack([v.get_value() for v in vars])
+        dF, dG = [], []
+        f_prev = g_prev = None
+        r_prev, d, i = np.inf, np.inf, 0
+        while d > d_limit and time() < t_limit and i < i_limit:
+            x = stack()
+            d = self.propagate(u, y, min_tau)
+            i += 1
+            g = stack()
+            f = g - x
+            r = np.linalg.norm(f)
+            if r > r_prev:
+                dF, dG = [], []
+            elif f_prev is not None:
+                dF = (dF + [f - f_prev])[-m:]
+                dG = (dG + [g - g_prev])[-m:]
+            f_prev, g_prev, r_prev = f, g, r
+            if dF == [] or d <= d_limit:
+                continue
+
+            # Regularized least squares fit of dF gamma = f for each sample
+            F, G = np.array(dF, dtype=np.float64), np.array(dG, dtype=np.float64)
+            A = np.einsum('idk,jdk->kij', F, F)
+            b = np.einsum('idk,dk->ki', F, f)
+            reg = 1e-12 + 1e-3 * np.trace(A, axis1=1, axis2=2) / len(dF)
+            A += reg[:, None, None] * np.identity(len(dF))
+            gamma = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+            x = g - np.einsum('idk,ki->dk', G, gamma)
+            for v, start, end in zip(vars, rows[:-1], rows[1:]):
+                v.set_value(np.float32(x[start:end]), borrow=True)
+        return i, d
+
+    def converge_samples(self, u, y, min_tau, d_limit, t_limit, i_limit):
+        """
+        Iterate until the relative change of the states of each sample drops
+        below d_limit. Converged samples are frozen and dropped from the
+        states so that later iterations process only the remaining ones.
+        Note that lerp then estimates its time constant from the remaining
+        samples only. Returns iterations taken and largest final delta.
+        """
+        rel_diff = lambda old, new: (
+            np.abs(np.mean(np.square(new) - np.square(old), axis=0)) /
+            (np.mean(np.square(old), axis=0) + 1e-5))
+        states = [(s.var, s.var.get_value()) for s in self.signal.values()]
+        active = np.arange(self.k)
+        delta = np.zeros(self.k, dtype=FLOATX)
+        u_, y_, i = u, y, 0
+        while len(active) > 0 and time() < t_limit and i < i_limit:
+            old = [var.get_value(borrow=True) for (var, _) in states]
+            self.propagate_layers(u_, y_, min_tau)
+            new = [var.get_value(borrow=True) for (var, _) in states]
+            d = np.max([rel_diff(o, n) for (o, n) in zip(old, new)], axis=0)
+            delta[active] = d
+            i += 1
+
+            done = d <= d_limit
+            if np.any(done):
+                # Compact the working states to the unconverged samples
+                for (var, full), x in zip(states, new):
+                    full[:, active[done]] = x[:, done]
+                    var.set_value(x[:, ~done], borrow=True)
+                active = active[~done]
+                u_ = u[:, active]
+                y_ = y[:, active] if y is not None else None
+
+        for (var, full) in states:
+            full[:, active] = var.get_value(borrow=True)
+            var.set_value(full, borrow=True)
+        return i, np.max(delta)
+
+    def compile_expr_f(self, name, exprs, inputs=[]):
+        """
+        Compile the expressions returned by exprs() once per model and bind
+        the function to this instance. Theano backend only.
+        """
+        self.update_plan()
+        if name not in self.exprf:
+            def build():
+                outputs = exprs()
+                keys, givens = state_inputs(self, outputs)
+                f = theano.function(inputs=inputs + [g for (_, g) in givens],
+                                    outputs=outputs,
+                                    givens=givens)
+                return f, keys
+            f, keys = self.mdl.compiled((name,), build)
+            self.exprf[name] = self.bind(f, keys, [])
+        return self.exprf[name]
+
     def x_est(self, no_eval=False):
         # TODO: Might not be reliable, fix.
         l = self.mdl.U
-        while l.next and not isinstance(l.next, CCALayer):
-            l = l.next
+        while l.next and not isinstance(l.next[0], CCALayer):
+            l = l.next[0]
         # Should this be Xbar or the feedforward ?
         v = l.signal(self).var
-        return v if no_eval else v.eval()
+        return v if no_eval else v.get_value()
 
     def u_est(self, no_eval=False):
-        v = self.mdl.U.estimate(self)
-        return v if no_eval else v.eval()
+        if no_eval or self.ops is NumpyOps:
+            return self.mdl.U.estimate(self)
+        return self.compile_expr_f('u_est', lambda: [self.u_est(True)])()
 
     def y_est(self, no_eval=False):
-        v = self.mdl.Y.estimate(self)
-        return v if no_eval else v.eval()
+        if no_eval or self.ops is NumpyOps:
+            return self.mdl.Y.estimate(self)
+        return self.compile_expr_f('y_est', lambda: [self.y_est(True)])()
 
     def u_err(self, u):
-        return T.mean(T.sqr(self.u_est(no_eval=True) - u)).eval()
+        if self.ops is NumpyOps:
+            return np.mean(np.square(self.u_est() - u))
+        u_t = T.matrix('u', dtype=FLOATX)
+        err = lambda: [T.mean(T.sqr(self.u_est(True) - u_t))]
+        return self.compile_expr_f('u_err', err, [u_t])(u)
+
+    def readout(self):
+        """
+        Return the states of U and of the top layer, and the estimates of
+        U and Y (None without Y), all transferred with a single call
+        """
+        def exprs():
+            return ([self.ops.value(self.U.var),
+                     self.ops.value(self.x_est(no_eval=True)),
+                     self.u_est(True)] +
+                    ([self.y_est(True)] if self.mdl.Y else []))
+        if self.ops is NumpyOps:
+            vals = [np.array(v) for v in exprs()]
+        else:
+            vals = list(self.compile_expr_f('readout', exprs)())
+        return tuple(vals + [None] * (4 - len(vals)))
 
     def first_phi(self):
         # index is omitted for now, and the lowest layer is plotted
-        return self.mdl.U.next.phi[0].get_value()
-
+        return self.mdl.first_phi()
+
+    def diagnostics(self):
+        """
+        Return statistics of all signals and the phi norms of all layers as
+        a dict of (name, value) lists. They are reduced with a single call
+        so only the results are transferred.
+        """
+        ops = self.ops
+        keys = sorted(self.signal.keys())
+        # In the order of phi_norms_expr()
+        names = sorted(l.name for l in self.mdl.iter_layers(skip_inputs=True))
+
+        def exprs():
+            stats = []
+            for k in keys:
+                x = ops.value(self.signal[k].var)
+                stats += [ops.mean(ops.log(ops.var(x, axis=1))),
+                          ops.mean(ops.sqr(x)),
+                          ops.sqrt(ops.sum(ops.sqr(ops.mean(x, axis=1))))]
+            return stats + self.mdl.phi_norms_expr(ops)[1]
+
+        if ops is NumpyOps:
+            vals = exprs()
+        else:
+            vals = self.compile_expr_f('diagnostics', exprs)()
+        n = len(keys)
+        sig_names = [self.signal[k].name for k in keys]
+        return {'variance': zip(sig_names, vals[0:3 * n:3]),
+                'energy': zip(sig_names, vals[1:3 * n:3]),
+                'avg_levels': zip(sig_names, vals[2:3 * n:3]),
+                'phi_norms': zip(names, vals[3 * n:])}
+
+    # Convenience wrappers, each runs diagnostics(), so call that instead to
+    # get more than one of them
     def variance(self, states=None):
-        f = lambda s: (s.name, s.variance())
-        return map(f, self.signal.values())
+        return self.diagnostics()['variance']
 
     def energy(self):
-        f = lambda s: (s.name, np.average(s.energy()))
-        return map(f, self.signal.values())
+        return self.diagnostics()['energy']
 
     def avg_levels(self):
-        f = lambda s: (s.name, np.linalg.norm(np.average(s.var.get_value(), axis=1)))
-        return map(f, self.signal.values())
+        return self.diagnostics()['avg_levels']
 
     def phi_norms(self):
-        f = lambda l: (l.name, (np.linalg.norm(l.phi[0].get_value(), axis=0)))
-        return map(f, self.iter_layers(skip_inputs=True))
+        return self.mdl.phi_norms(self.ops)
 
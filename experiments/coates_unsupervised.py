@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 from eca import ECA, Input, Layer
 from utils import imshowtiled, rect, Cifar10Dataset
-from sklearn.svm import LinearSVC
 import sys
 
 
@@ -26,31 +26,62 @@ class ECAUnsupervised(object):
         class Model(ECA):
             def structure(self):
                 self.U = Input('U', n)
+                # Only the diagonal of E_XX is needed, saves O(dim^2) work,
+                # and phi is derived from E_XU instead of stored twice
                 self.X = Layer('X1', dim, [self.U], rect,
-                               min_tau=0., stiffx=1.0)
+                               min_tau=0., stiffx=1.0, diag_stats=True,
+                               store_phi=False)
         self.mdl = Model()
 
     def learn(self, iterations):
         trn_sig = self.mdl.new_signals(self.k)
-        stiff_start, stiff_end, stiff_decay = (0.5, 0.001, 0.95)
-        stiff_update = lambda s: s * stiff_decay + (1 - stiff_decay) * stiff_end
-        stiff = stiff_start
-        for i in range(1, iterations + 1):
-            if i % 10 == 1:
-                print 'Iteration', i, '/', iterations + 1
-            trn_sig.propagate(self.train_data, None)
-            trn_sig.adapt_layers(stiff)
-            stiff = stiff_update(stiff)
+        trn_sig.bind_input(self.train_data)
+        # All iterations run in one compiled loop
+        stiff, _, _ = trn_sig.train(self.train_data, None, iterations,
+                                    stiff=(0.5, 0.001, 0.95))
+        print 'Trained', iterations, 'iterations, final stiffness %.4f' % stiff
         return self.mdl.first_phi()
 
     def transform(self, data):
         k = data.shape[1]
-        if self.sig is None or self.sig.k != k:
+        if self.sig is None:
             self.sig = self.mdl.new_signals(k)
-        self.sig.converge(data, None)
+        self.sig.resize(k).converge(data, None)
         return self.sig.U.next.val()
 
+    def convolve(self, inp, w, stride, chunk=50000):
+        """
+        Sum pooled features of all w x w patches of 32x32 images into a
+        2x2 grid. Patches of as many images as fit in chunk columns are
+        transformed together, so each converge is a large batch. The time
+        constants of the converge then depend on the whole batch, so the
+        features differ from converging each position separately at about
+        the level of the convergence limit.
+        """
+        samples = inp.shape[1]
+        assert inp.shape == (32 * 32 * 3, samples)
+        pos = np.arange(0, 32 - w + 1, stride)
+        p = len(pos)
+        quadrant = [pos // 16 == q for q in range(2)]
+        conv = np.zeros((2, 2, self.dim, samples), dtype=np.float32)
+        n = max(1, chunk // (p * p))
+        for i in xrange(0, samples, n):
+            print 'Images', i + 1, '-', min(i + n, samples), '/', samples
+            d = np.ascontiguousarray(inp[:, i:i + n]).reshape(32, 32, 3, -1)
+            s = d.strides
+            # All patches as columns ordered by position and image
+            win = as_strided(d, shape=(p, p, w, w) + d.shape[2:],
+                             strides=(s[0] * stride, s[1] * stride) + s)
+            patches = win.transpose(2, 3, 4, 0, 1, 5).reshape(w * w * 3, -1)
+            latent = self.transform(patches).reshape(self.dim, p, p, -1)
+            for x in range(2):
+                for y in range(2):
+                    conv[x, y, :, i:i + n] = np.sum(
+                        latent[:, quadrant[x]][:, :, quadrant[y]], axis=(1, 2))
+        return conv.reshape(4 * self.dim, samples)
+
 def run(dry_run=False):
+    from sklearn.svm import LinearSVC
     #47.3 % for M: 10000 K: 100 W: 6 stride: 1 trn_m: 5000 tst_m: 1000
     #60.1 % for M: 10000 K: 1000 W: 6 stride: 1 trn_m: 5000 tst_m: 1000
     #57.4 % for M: 10000 K: 1000 W: 8 stride: 1 trn_m: 5000 tst_m: 1000
@@ -98,25 +129,10 @@ def run(dry_run=False):
         if not dry_run:
             imshowtiled(feats)
 
-        print 'Applying convolution to train data'
-
-        def convolve(inp, s):
-            samples = inp.shape[1]
-            conv = np.zeros((2, 2, K, samples))
-            assert inp.shape == (32*32*3, samples)
-            d = inp.reshape(32, 32, 3, samples)
-            for x in xrange(0, 32 - W + 1, s):
-                print 'Row', x // s + 1
-                for y in xrange(0, 32 - W + 1, s):
-                    latent = unsup.transform(d[x:x+W, y:y+W, :, :].reshape(W * W * 3, samples))
-                    conv[x // 16, y // 16, :, :] += latent
-                    #conv[x // 16, y // 16, :, :] = np.maximum(conv[x // 16, y // 16, :, :], latent)
-            return conv.reshape(4 * K, samples)
-
         # Fitting SVN with input data
         print 'Extracting features for training data'
         d = data.get('trn')
-        trn_feats = convolve(d.samples, stride)
+        trn_feats = unsup.convolve(d.samples, W, stride)
         print 'Training SVM'
         clf = LinearSVC()
         clf.fit(trn_feats.T, d.labels)
@@ -124,7 +140,7 @@ def run(dry_run=False):
         # Fitting SVN with input data
         print 'Extracting features for validation data'
         d = data.get('val')
-        val_feats = convolve(d.samples, stride)
+        val_feats = unsup.convolve(d.samples, W, stride)
         print 'Predicting results'
         pred = clf.predict(val_feats.T)
         print 100.0 * d.accuracy(pred), '% for',
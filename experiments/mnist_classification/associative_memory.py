@@ -34,6 +34,7 @@ def run(dry_run=False):
     weights = []
     try:
         trn_sig = mdl.new_signals(data.samples('trn'))
+        trn_sig.bind_input(d.samples)
         trne_sig = mdl.new_signals(data.samples('trn'))
         val_sig = mdl.new_signals(data.samples('val'))
         tst_sig = mdl.new_signals(data.samples('tst'))
@@ -57,14 +58,15 @@ def run(dry_run=False):
 
                 tostr = lambda t: "{" + ", ".join(["%s: %6.2f" % (n, v) for (n, v) in t]) + "}"
 
-                var_str = " logvar:" + tostr(trn_sig.variance())
-                a_str   = " avg:   " + tostr(trn_sig.avg_levels())
-                phi_norms = mdl.phi_norms()
+                diag = trn_sig.diagnostics()
+                var_str = " logvar:" + tostr(diag['variance'])
+                a_str   = " avg:   " + tostr(diag['avg_levels'])
+                phi_norms = diag['phi_norms']
                 phi_larg_str = " |phinL|: " + tostr(map(lambda a: (a[0], np.sum(a[1] > 1.1)), phi_norms))
                 phi_ones_str = " |phin1|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 1.0, atol=0.1))), phi_norms))
                 phi_zero_str = " |phin0|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 0.0, atol=0.5))), phi_norms))
                 phi_str = " |phi|: " + tostr(map(lambda a: (a[0], np.average(a[1])), phi_norms))
-                E_str = " E: " + tostr(trn_sig.energy())
+                E_str = " E: " + tostr(diag['energy'])
                 trn_err = " acc: " + str(d.accuracy(trn_sig.u_est()) * 100.)
 
                 print i_str, stiff_str, t_str, E_str, phi_ones_str, trn_err
@@ -92,8 +94,10 @@ def calculate_accuracy(trn, val, tst, data):
     d.accuracy(-y_est, print_it=True)
 
     d = data.get('val')
-    d.samples[-10:, :] = 0.0
-    val.converge(d.samples, None)
+    # Minibatches are views of the dataset, modify a copy
+    u = d.samples.copy()
+    u[-10:, :] = 0.0
+    val.converge(u, None)
     #y_est = val.u_est()
     y_est = -val.U.var.get_value()
     d.accuracy(y_est, print_it=True)
@@ -2,8 +2,6 @@
 import time
 import numpy as np
 
-import theano.tensor as T
-
 from eca import ECA, Input, Layer
 from utils import visualize, rect, MnistDataset, imshowtiled
 import matplotlib.pyplot as plt
@@ -21,15 +19,13 @@ def impute(data, test_k, mdl, test_sig, guessed, true, sample=False):
     fig.set_size_inches(15.5, 10.5)
     inplot = inp.copy()
     inplot[np.isnan(inp)] = 0.5
-    u_est = test_sig.u_est(no_eval=True)
+    u_est = test_sig.u_est()
     if sample:
-        u_est = T.sqr(u_est).eval()
+        u_est = np.square(u_est)
         u_est -= np.minimum(0, np.min(u_est))
         u_est /= np.max(u_est) * 5
         guesses = np.random.binomial(n=1, p=u_est, size=(784, test_k))
         guessed = np.float32(np.where(np.isnan(guessed) & guesses == 1.0, guesses, guessed))
-    else:
-        u_est = u_est.eval()
     imshowtiled(mdl.first_phi(), axis=ax[0])
     imshowtiled(test_sig.U.var.get_value(), axis=ax[1])
     imshowtiled(u_est, axis=ax[2])
@@ -67,6 +63,7 @@ def run(dry_run=False):
     try:
         rng = np.random.RandomState(seed=0)
         trn_sig = mdl.new_signals(k)
+        trn_sig.bind_input(d.samples)
         test_k = 25
         test_sig = mdl.new_signals(test_k)
 
@@ -95,14 +92,15 @@ def run(dry_run=False):
 
                 tostr = lambda t: "{" + ", ".join(["%s: %6.2f" % (n, v) for (n, v) in t]) + "}"
 
-                var_str = " logvar:" + tostr(trn_sig.variance())
-                a_str   = " avg:   " + tostr(trn_sig.avg_levels())
-                phi_norms = mdl.phi_norms()
+                diag = trn_sig.diagnostics()
+                var_str = " logvar:" + tostr(diag['variance'])
+                a_str   = " avg:   " + tostr(diag['avg_levels'])
+                phi_norms = diag['phi_norms']
                 phi_larg_str = " |phinL|: " + tostr(map(lambda a: (a[0], np.sum(a[1] > 1.1)), phi_norms))
                 phi_ones_str = " |phin1|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 1.0, atol=0.1))), phi_norms))
                 phi_zero_str = " |phin0|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 0.0, atol=0.5))), phi_norms))
                 phi_str = " |phi|: " + tostr(map(lambda a: (a[0], np.average(a[1])), phi_norms))
-                E_str = " E: " + tostr(trn_sig.energy())
+                E_str = " E: " + tostr(diag['energy'])
                 u_err = ' uerr: %.5f' % trn_sig.u_err(d.samples)
                 U_sqr = ' Usqr: %.5f' % np.average(np.square(trn_sig.U.var.get_value()))
 
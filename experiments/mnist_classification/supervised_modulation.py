@@ -2,7 +2,7 @@
 import time
 import numpy as np
 
-from eca import ECA, Input, Layer
+from eca import ECA, Input, Layer, StateCache
 from utils import visualize, rect, MnistDataset
 
 
@@ -31,8 +31,11 @@ def run(dry_run=False):
     weights = []
     try:
         trn_sig = mdl.new_signals(data.samples('trn'))
-        trne_sig = mdl.new_signals(data.samples('trn'))
-        val_sig = mdl.new_signals(data.samples('val'))
+        trn_sig.bind_input(d.samples)
+        # Evaluation converges the same samples again and again
+        cache = StateCache()
+        trne_sig = mdl.new_signals(data.samples('trn'), cache=cache)
+        val_sig = mdl.new_signals(data.samples('val'), cache=cache)
         tst_sig = mdl.new_signals(data.samples('tst'))
 
         # "Module model" so that it updates only certain weights at a time
@@ -62,14 +65,15 @@ def run(dry_run=False):
 
                 tostr = lambda t: "{" + ", ".join(["%s: %6.2f" % (n, v) for (n, v) in t]) + "}"
 
-                var_str = " logvar:" + tostr(trn_sig.variance())
-                a_str   = " avg:   " + tostr(trn_sig.avg_levels())
-                phi_norms = mdl.phi_norms()
+                diag = trn_sig.diagnostics()
+                var_str = " logvar:" + tostr(diag['variance'])
+                a_str   = " avg:   " + tostr(diag['avg_levels'])
+                phi_norms = diag['phi_norms']
                 phi_larg_str = " |phinL|: " + tostr(map(lambda a: (a[0], np.sum(a[1] > 1.1)), phi_norms))
                 phi_ones_str = " |phin1|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 1.0, atol=0.1))), phi_norms))
                 phi_zero_str = " |phin0|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 0.0, atol=0.5))), phi_norms))
                 phi_str = " |phi|: " + tostr(map(lambda a: (a[0], np.average(a[1])), phi_norms))
-                E_str = " E: " + tostr(trn_sig.energy())
+                E_str = " E: " + tostr(diag['energy'])
 
                 print i_str, stiff_str, t_str, E_str, phi_ones_str
                 #print var_str, a_str, phi_str
@@ -4,7 +4,7 @@ import numpy as np
 
 import theano.tensor as T
 
-from eca import ECA, Input, RegressionLayer
+from eca import ECA, Input, RegressionLayer, StateCache
 from utils import visualize, rect, MnistDataset
 
 
@@ -43,8 +43,11 @@ def run(dry_run=False):
     weights = []
     try:
         trn_sig = mdl.new_signals(data.samples('trn'))
-        trne_sig = mdl.new_signals(data.samples('trn'))
-        val_sig = mdl.new_signals(data.samples('val'))
+        trn_sig.bind_input(d.samples, d.labels)
+        # Evaluation converges the same samples again and again
+        cache = StateCache()
+        trne_sig = mdl.new_signals(data.samples('trn'), cache=cache)
+        val_sig = mdl.new_signals(data.samples('val'), cache=cache)
         tst_sig = mdl.new_signals(data.samples('tst'))
         for i in range(1, trn_iters + 1):
             t = time.time()
@@ -66,18 +69,19 @@ def run(dry_run=False):
 
                 tostr = lambda t: "{" + ", ".join(["%s: %6.2f" % (n, v) for (n, v) in t]) + "}"
 
-                var_str = " logvar:" + tostr(trn_sig.variance())
-                a_str   = " avg:   " + tostr(trn_sig.avg_levels())
-                phi_norms = mdl.phi_norms()
+                diag = trn_sig.diagnostics()
+                var_str = " logvar:" + tostr(diag['variance'])
+                a_str   = " avg:   " + tostr(diag['avg_levels'])
+                phi_norms = diag['phi_norms']
                 phi_larg_str = " |phinL|: " + tostr(map(lambda a: (a[0], np.sum(a[1] > 1.1)), phi_norms))
                 phi_ones_str = " |phin1|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 1.0, atol=0.1))), phi_norms))
                 phi_zero_str = " |phin0|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 0.0, atol=0.5))), phi_norms))
                 phi_str = " |phi|: " + tostr(map(lambda a: (a[0], np.average(a[1])), phi_norms))
-                E_str = " E: " + tostr(trn_sig.energy())
+                E_str = " E: " + tostr(diag['energy'])
                 y_acc = " yacc: %.2f" % (d.accuracy(trn_sig.y_est()) * 100.)
                 Y_acc = " Yacc: %.2f" % (d.accuracy(trn_sig.Y.var.get_value()) * 100.)
-                Y_cost = " Yerr: %.3f" % np.mean(trn_sig.Y.energy())
-                U_cost = " Uerr: %.3f" % np.mean(trn_sig.U.energy())
+                Y_cost = " Yerr: %.3f" % dict(diag['energy'])['Y']
+                U_cost = " Uerr: %.3f" % dict(diag['energy'])['U']
 
                 print i_str, stiff_str, t_str, y_acc, Y_acc, Y_cost, U_cost, phi_ones_str
                 #print var_str, a_str, phi_str
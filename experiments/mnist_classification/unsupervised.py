@@ -38,6 +38,7 @@ def run(dry_run=False):
     weights = []
     try:
         trn_sig = mdl.new_signals(data.samples('trn'))
+        trn_sig.bind_input(d.samples)
         for i in range(1, trn_iters + 1):
             t = time.time()
             # Update model
@@ -90,7 +91,7 @@ def run(dry_run=False):
                 ax[0, 1].set_ylim([0.2, 5])
 
                 XE2 = np.mean(np.square(X2), axis=1)
-                nphi2 = np.linalg.norm(mdl.X2.phi.get_value().T, axis=1)
+                nphi2 = np.linalg.norm(mdl.X2.get_phi().T, axis=1)
 
                 order = np.arange(len(XE2))
                 Q2 = mdl.X2.Q.get_value()
@@ -125,14 +126,15 @@ def run(dry_run=False):
 
                 tostr = lambda t: "{" + ", ".join(["%s: %6.2f" % (n, v) for (n, v) in t]) + "}"
 
-                var_str = " logvar:" + tostr(trn_sig.variance())
-                a_str   = " avg:   " + tostr(trn_sig.avg_levels())
-                phi_norms = mdl.phi_norms()
+                diag = trn_sig.diagnostics()
+                var_str = " logvar:" + tostr(diag['variance'])
+                a_str   = " avg:   " + tostr(diag['avg_levels'])
+                phi_norms = diag['phi_norms']
                 phi_larg_str = " |phinL|: " + tostr(map(lambda a: (a[0], np.sum(a[1] > 1.1)), phi_norms))
                 phi_ones_str = " |phin1|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 1.0, atol=0.1))), phi_norms))
                 phi_zero_str = " |phin0|: " + tostr(map(lambda a: (a[0], np.sum(np.isclose(a[1], 0.0, atol=0.5))), phi_norms))
                 phi_str = " |phi|: " + tostr(map(lambda a: (a[0], np.average(a[1])), phi_norms))
-                E_str = " E: " + tostr(trn_sig.energy())
+                E_str = " E: " + tostr(diag['energy'])
                 u_err = ' uerr: %.5f' % trn_sig.u_err(d.samples)
                 U_sqr = ' Usqr: %.5f' % np.average(np.square(trn_sig.U.var.get_value()))
 
@@ -0,0 +1,563 @@
+import numpy as np
+import theano
+import eca
+from eca import ECA, Input, Layer, ConvLayer, RegressionLayer
+from utils import rect
+from test_utils import RandomDataset
+
+
+class TwoWayModel(ECA):
+    def structure(self):
+        self.U = Input('U', 20)
+        self.Y = Input('Y', 4)
+        RegressionLayer('Z', 5, (self.U, self.Y), rect,
+                        merge_op=lambda u, y: rect(u + y))
+
+
+class DeepModel(ECA):
+    def structure(self):
+        self.U = Input('U', 20)
+        self.X1 = Layer('X1', 8, self.U, rect)
+        self.X2 = Layer('X2', 4, self.X1, None)
+
+
+class DiagModel(ECA):
+    def structure(self):
+        self.U = Input('U', 20)
+        self.X1 = Layer('X1', 8, self.U, rect, diag_stats=True)
+        self.X2 = Layer('X2', 4, self.X1, None, diag_stats=True)
+
+
+class DerivedPhiModel(ECA):
+    def structure(self):
+        self.U = Input('U', 20)
+        self.X1 = Layer('X1', 8, self.U, rect, store_phi=False)
+        self.X2 = Layer('X2', 4, self.X1, None, diag_stats=True,
+                        store_phi=False)
+
+
+class FanInModel(ECA):
+    def structure(self):
+        self.U = Input('U', 20)
+        self.Y = Input('Y', 4)
+        self.X1 = Layer('X1', 6, [self.U, self.Y], rect)
+        self.X2 = Layer('X2', 3, [self.X1, self.Y], None, store_phi=False)
+
+
+class ConvModel(ECA):
+    def structure(self):
+        self.U = Input('U', 20)
+        self.X1 = ConvLayer('X1', 3, 2, self.U, rect, shape=(5, 4, 1))
+        self.X2 = ConvLayer('X2', 2, 2, self.X1, None, diag_stats=True,
+                            store_phi=False)
+        self.X3 = Layer('X3', 4, self.X2, None)
+
+
+def data(k=30):
+    rng = np.random.RandomState(1)
+    u = np.float32(rng.randn(20, k))
+    y = np.float32(rng.randn(4, k))
+    return u, y
+
+
+def params(mdl):
+    ps = []
+    for l in mdl.iter_layers(skip_inputs=True):
+        ps += l.E_XU + l.phi + [l.Q, l.E_XX]
+    return ps
+
+
+def train(mdl, backend, iters=5, bind=False, modulate=False, **kwargs):
+    u, y = data()
+    # Missing values exercise the input masks
+    u[0, :5] = np.nan
+    sig = mdl.new_signals(u.shape[1], backend=backend, **kwargs)
+    y = y if mdl.Y else None
+    if bind:
+        sig.bind_input(u, y)
+    rng = np.random.RandomState(2)
+    for i in range(iters):
+        if modulate:
+            x = sig.U.next
+            x.set_modulation(np.float32(rng.uniform(size=(x.n, x.k))))
+        sig.propagate(u, y)
+        sig.adapt_layers(0.5)
+    return sig, mdl.first_phi()
+
+
+def compare(Model, a, b, atol=1e-5):
+    """ Train the same model with both settings and compare the results """
+    mdl = Model()
+    init = [(p, p.get_value()) for p in params(mdl)]
+    sig_a, phi_a = train(mdl, **a)
+    for p, v in init:
+        p.set_value(v)
+    sig_b, phi_b = train(mdl, **b)
+    for key in sig_a.signal:
+        assert np.allclose(sig_a.signal[key].val(), sig_b.signal[key].val(),
+                           atol=atol), key
+    assert np.allclose(phi_a, phi_b, atol=atol)
+
+
+def test_numpy_backend():
+    for Model in [TwoWayModel, DeepModel, DiagModel, DerivedPhiModel,
+                  FanInModel]:
+        compare(Model, dict(backend='theano'), dict(backend='numpy'))
+
+
+def test_function_cache(tmpdir):
+    u, _ = data()
+    mdl = DeepModel()
+    sig = [mdl.new_signals(u.shape[1]) for i in range(2)]
+    n = len(mdl.functions)
+    for s in sig:
+        s.propagate(u, None)
+    assert np.allclose(sig[0].U.val(), sig[1].U.val())
+    sig[0].adapt_layers(0.5)
+    sig[1].adapt_layers(0.5)
+    assert len(mdl.functions) == n + 2
+
+    # Functions loaded from disk must update parameters of the new model
+    eca.FUNCTION_CACHE_DIR = str(tmpdir)
+    try:
+        for i in range(2):
+            mdl = DeepModel()
+            before = mdl.first_phi()
+            mdl.new_signals(u.shape[1]).adapt_layers(0.5)
+            assert not np.allclose(before, mdl.first_phi())
+            assert len(tmpdir.listdir()) == len(mdl.functions)
+        # Fused functions come with the keys of their outputs
+        DeepModel().new_signals(u.shape[1], fused=True).propagate(u, None)
+        # Scan loops that cannot be pickled are still compiled and used
+        u, y = data()
+        for Model in [TwoWayModel, ConvModel]:
+            states = []
+            for i in range(2):
+                mdl = Model()
+                y_ = y if mdl.Y else None
+                sig = mdl.new_signals(u.shape[1], scan=True)
+                sig.train(u, y_, 2)
+                sig.converge(u, y_)
+                states += [sig.U.next.val()]
+            assert np.allclose(states[0], states[1])
+        assert not [p for p in tmpdir.listdir() if not p.ext == '.pkl']
+    finally:
+        eca.FUNCTION_CACHE_DIR = None
+
+
+def test_fused_propagation():
+    for Model in [TwoWayModel, DeepModel]:
+        compare(Model, dict(backend='theano'), dict(backend='theano', fused=True))
+
+
+def test_bound_input():
+    for Model in [TwoWayModel, DeepModel]:
+        for backend in ['theano', 'numpy']:
+            compare(Model, dict(backend=backend),
+                    dict(backend=backend, bind=True))
+        compare(Model, dict(backend='theano', fused=True),
+                dict(backend='theano', fused=True, bind=True))
+
+
+def test_device_outputs():
+    u, y = data()
+    mdl = TwoWayModel()
+    internal = lambda s: s.var.get_value(borrow=True, return_internal_type=True)
+    for kwargs in [{}, dict(fused=True), dict(scan=True)]:
+        sig = mdl.new_signals(u.shape[1], **kwargs)
+        types = dict((k, type(internal(s))) for k, s in sig.signal.items())
+        sig.propagate(u, y)
+        sig.bind_input(u, y).propagate(u, y)
+        sig.converge(u, y)
+        sig.train(u, y, 2)
+        for k, s in sig.signal.items():
+            assert type(internal(s)) is types[k], k
+    # New states are output in the type of the states they replace
+    sig = mdl.new_signals(u.shape[1])
+    for compiled in mdl.functions.values():
+        if len(compiled) == 3:
+            f, _, out = compiled
+            for o, k in zip(f.maker.outputs, out):
+                assert o.variable.type == sig.signal[k].var.type, k
+
+
+def test_modulation():
+    compare(DeepModel, dict(backend='theano', modulate=True),
+            dict(backend='numpy', modulate=True))
+    mdl = DeepModel()
+    sig, _ = train(mdl, 'theano', iters=1, modulate=True)
+    n = len(mdl.functions)
+    before = mdl.X1.E_XU[0].get_value()
+    sig.U.next.set_modulation(np.zeros((8, 30)))
+    sig.adapt_layers(0.5)
+    assert len(mdl.functions) == n
+    # Zero modulation drives the statistics towards zero
+    assert np.all(np.abs(mdl.X1.E_XU[0].get_value()) <= np.abs(before))
+
+
+def test_scan_converge():
+    u, y = data()
+    for Model in [TwoWayModel, DeepModel]:
+        mdl = Model()
+        y = y if mdl.Y else None
+        sig = [mdl.new_signals(u.shape[1], scan=scan) for scan in [False, True]]
+        for s in sig:
+            s.converge(u, y)
+        assert sig[0].iters == sig[1].iters
+        assert np.isclose(sig[0].delta, sig[1].delta, atol=1e-5)
+        for key in sig[0].signal:
+            assert np.allclose(sig[0].signal[key].val(),
+                               sig[1].signal[key].val(), atol=1e-5)
+
+
+def test_per_sample_converge():
+    u, _ = data()
+    mdl = DeepModel()
+    trn = mdl.new_signals(u.shape[1])
+    for i in range(50):
+        trn.propagate(u, None)
+        trn.adapt_layers(0.5)
+    sig = [mdl.new_signals(u.shape[1]) for i in range(2)]
+    sig[0].converge(u, None)
+    sig[1].converge(u, None, per_sample=True)
+    assert sig[1].delta <= 1e-3
+    for key in sig[0].signal:
+        a, b = sig[0].signal[key].val(), sig[1].signal[key].val()
+        assert a.shape == b.shape
+        assert np.allclose(a, b, atol=0.1 * np.max(np.abs(a)))
+
+
+def test_diag_stats():
+    u, _ = data()
+    mdl = DiagModel()
+    sig = mdl.new_signals(u.shape[1])
+    for i in range(5):
+        sig.propagate(u, None)
+        sig.adapt_layers(0.5)
+    X1 = sig.signal['X1'].val()
+    E_XX = mdl.X1.E_XX.get_value()
+    assert E_XX.shape == (8, 1)
+    assert np.allclose(mdl.X1.q(), 1. / np.maximum(E_XX[:, 0], 0.5))
+    phi = mdl.X1.q()[:, None] * mdl.X1.E_XU[0].get_value()
+    assert np.allclose(mdl.X1.phi[0].get_value(), phi.T)
+    assert np.all(E_XX > 0) and np.all(np.isfinite(X1))
+
+
+def test_derived_phi():
+    u, _ = data()
+    mdl = DerivedPhiModel()
+    sig = mdl.new_signals(u.shape[1])
+    for i in range(5):
+        sig.propagate(u, None)
+        sig.adapt_layers(0.5)
+    assert mdl.X1.phi == [] and mdl.X2.phi == []
+    for l in [mdl.X1, mdl.X2]:
+        phi = np.dot(np.diag(l.q()), l.E_XU[0].get_value()).T
+        assert np.allclose(l.get_phi(), phi)
+    X1 = sig.signal['X1'].val()
+    ff = np.dot(mdl.X2.get_phi().T, X1)
+    assert np.allclose(mdl.X2.feedforward(sig).eval(), ff, atol=1e-5)
+    fb = np.dot(mdl.X1.get_phi(), X1)
+    assert np.allclose(mdl.X1.feedback(sig, mdl.U).eval(), fb, atol=1e-5)
+
+
+def test_train_batches():
+    d = RandomDataset(batch_size=30)
+    assert d.batches('trn') == 4
+    mdl = DeepModel()
+    sig = mdl.new_signals(30)
+    stiff, rate = sig.train_batches(d, 0.5, lambda s: s * 0.9, iters=2)
+    assert np.isclose(stiff, 0.5 * 0.9 ** 8) and rate > 0
+    # The last bound minibatch is the partial fourth one
+    assert np.allclose(sig.inputs['U'][0].get_value(), d.get('trn', 3).samples)
+    assert sig.k == 30 and sig.U.val().shape == (sig.U.n, 30)
+
+
+def test_readout():
+    u, y = data()
+    mdl = TwoWayModel()
+    sig = [mdl.new_signals(u.shape[1], backend=b) for b in ['theano', 'numpy']]
+    for s in sig:
+        s.propagate(u, y)
+    out = [s.readout() for s in sig]
+    for a, b in zip(*out):
+        assert np.allclose(a, b, atol=1e-5)
+    assert np.allclose(out[0][2], sig[0].u_est())
+    assert np.allclose(out[0][3], sig[0].y_est())
+    assert np.isclose(sig[0].u_err(u), sig[1].u_err(u))
+    # Readouts are compiled only once
+    n = len(mdl.functions)
+    sig[0].propagate(u, y)
+    sig[0].readout(), sig[0].u_est(), sig[0].u_err(u)
+    assert len(mdl.functions) == n
+
+
+def test_diagnostics():
+    u, y = data()
+    for Model in [TwoWayModel, DerivedPhiModel]:
+        mdl = Model()
+        sig = mdl.new_signals(u.shape[1])
+        sig.propagate(u, y if mdl.Y else None)
+        sig.adapt_layers(0.5)
+        diag = sig.diagnostics()
+        for name, v in diag['energy']:
+            x = [s for s in sig.signal.values() if s.name == name][0].val()
+            assert np.isclose(v, np.mean(np.square(x)), rtol=1e-4)
+            assert np.isclose(dict(diag['variance'])[name],
+                              np.mean(np.log(np.var(x, axis=1))), rtol=1e-4)
+        norms = dict(diag['phi_norms'])
+        for l in mdl.iter_layers(skip_inputs=True):
+            expected = np.linalg.norm(l.get_phi(), axis=0)
+            assert np.allclose(norms[l.name], expected, rtol=1e-4)
+            assert np.allclose(dict(mdl.phi_norms())[l.name], expected, rtol=1e-4)
+        # The numpy backend compiles nothing
+        mdl = Model()
+        sig = mdl.new_signals(u.shape[1], backend='numpy')
+        sig.diagnostics()
+        norms = dict(sig.phi_norms())
+        assert len(mdl.functions) == 0
+        for l in mdl.iter_layers(skip_inputs=True):
+            expected = np.linalg.norm(l.get_phi(), axis=0)
+            assert np.allclose(norms[l.name], expected, rtol=1e-4)
+
+
+def test_plan():
+    names = lambda layers: [l.name for l in layers]
+    assert names(DeepModel().plan()) == ['U', 'X1', 'X2']
+    assert names(DeepModel().plan('top-down')) == ['X2', 'X1', 'U']
+    assert names(TwoWayModel().plan()) == ['U', 'Y', 'Zu', 'Zy']
+    mdl = DeepModel()
+    assert mdl.plan() is mdl.plan()
+
+    u, _ = data()
+    for i in range(20):
+        mdl.new_signals(u.shape[1]).propagate(u, None)
+    sig = [mdl.new_signals(u.shape[1], order=order) for order in eca.ORDERS]
+    for s in sig:
+        s.converge(u, None)
+        assert s.delta <= 1e-3
+    for key in sig[0].signal:
+        a = sig[0].signal[key].val()
+        for s in sig[1:]:
+            assert np.allclose(a, s.signal[key].val(), atol=0.1 * np.max(np.abs(a)))
+
+
+def test_jacobi():
+    jacobi = dict(backend='theano', order='jacobi')
+    for Model in [TwoWayModel, DeepModel]:
+        compare(Model, jacobi, dict(jacobi, fused=True))
+        compare(Model, jacobi, dict(backend='numpy', order='jacobi', threads=2))
+    # Signals share their threads
+    sig = [DeepModel().new_signals(10, order='jacobi', threads=2)
+           for i in range(2)]
+    assert sig[0].pool is sig[1].pool is eca.POOLS[2]
+    # All layers see the states of the previous step
+    u, _ = data()
+    mdl = DeepModel()
+    sig = mdl.new_signals(u.shape[1], order='jacobi')
+    before = dict((k, s.val()) for k, s in sig.signal.items())
+    sig.propagate(u, None)
+    ff = rect(np.dot(mdl.X1.get_phi().T, before['U']))
+    fb = np.dot(mdl.X2.get_phi(), before['X2'])
+    new, _, _ = eca.lerp(before['X1'], ff - fb, ops=eca.NumpyOps)
+    assert np.allclose(sig.signal['X1'].val(), new, atol=1e-5)
+
+
+def test_disabled_layers():
+    u, _ = data()
+    mdl = DeepModel()
+    mdl.X2.disable()
+    assert [l.name for l in mdl.plan()] == ['U', 'X1']
+    sig = mdl.new_signals(u.shape[1])
+    X1, X2 = sig.signal['X1'].val(), sig.signal['X2'].val()
+    E_XU = mdl.X2.E_XU[0].get_value()
+    sig.propagate(u, None)
+    # X1 gets no feedback and X2 is left as it is
+    ff = rect(np.dot(mdl.X1.get_phi().T, sig.U.val()))
+    assert np.allclose(sig.signal['X1'].val(),
+                       eca.lerp(X1, ff, ops=eca.NumpyOps)[0], atol=1e-5)
+    sig.adapt_layers(0.5)
+    assert np.allclose(sig.signal['X2'].val(), X2)
+    assert np.allclose(mdl.X2.E_XU[0].get_value(), E_XU)
+
+    mdl.X2.enable()
+    sig.propagate(u, None)
+    sig.adapt_layers(0.5)
+    assert not np.allclose(sig.signal['X2'].val(), X2)
+    # Functions of both configurations are kept
+    n = len(mdl.functions)
+    for i in range(2):
+        mdl.X2.disable()
+        sig.propagate(u, None)
+        mdl.X2.enable()
+        sig.propagate(u, None)
+    assert len(mdl.functions) == n
+
+
+def test_fan_in():
+    u, y = data()
+    mdl = FanInModel()
+    sig = mdl.new_signals(u.shape[1])
+    for i in range(3):
+        sig.propagate(u, y)
+        sig.adapt_layers(0.5)
+    assert mdl.X1.phi[0].get_value().shape == (24, 6)
+    phi = [mdl.X1.get_phi(i) for i in range(2)]
+    assert phi[0].shape == (20, 6) and phi[1].shape == (4, 6)
+    U, Y = sig.U.val(), sig.Y.val()
+    ff = np.dot(phi[0].T, U) + np.dot(phi[1].T, Y)
+    assert np.allclose(mdl.X1.feedforward(sig).eval(), ff, atol=1e-5)
+    # Statistics of each previous layer are in their own block
+    X1 = sig.signal['X1'].val()
+    fb = np.dot(mdl.X1.get_phi(1), X1) + np.dot(mdl.X2.get_phi(1),
+                                                sig.signal['X2'].val())
+    est = mdl.Y.estimate(sig)
+    assert np.allclose(est.eval(), fb, atol=1e-5)
+    # Y has two next layers, their feedbacks are added without stacking
+    g = theano.gof.graph
+    assert all(o.ndim <= 2 for n in g.ops(g.inputs([est]), [est])
+               for o in n.outputs)
+    sig_np = mdl.new_signals(u.shape[1], backend='numpy')
+    for k, s in sig.signal.items():
+        sig_np.signal[k].var.set_value(s.val())
+    assert np.allclose(mdl.Y.estimate(sig_np), fb, atol=1e-5)
+    assert mdl.X2.get_phi(0).shape == (6, 3)
+
+
+def test_anderson_converge():
+    for Model in [DeepModel, TwoWayModel]:
+        mdl = Model()
+        u, y = data()
+        y = y if mdl.Y else None
+        trn = mdl.new_signals(u.shape[1])
+        for i in range(50):
+            trn.propagate(u, y)
+            trn.adapt_layers(0.5)
+        sig = [mdl.new_signals(u.shape[1]) for i in range(2)]
+        sig[0].converge(u, y)
+        sig[1].converge(u, y, anderson=5)
+        assert sig[1].delta <= 1e-3
+        assert sig[1].iters < sig[0].iters
+        for key in sig[0].signal:
+            a, b = sig[0].signal[key].val(), sig[1].signal[key].val()
+            assert np.allclose(a, b, atol=0.01 * np.max(np.abs(a)))
+
+
+def test_state_cache():
+    u, _ = data()
+    mdl = DeepModel()
+    trn = mdl.new_signals(u.shape[1])
+    for i in range(50):
+        trn.propagate(u, None)
+        trn.adapt_layers(0.5)
+    cache = eca.StateCache()
+    sig = mdl.new_signals(u.shape[1], cache=cache)
+    first = sig.converge(u, None).iters
+    sig.converge(u[:, ::-1], None)
+    assert len(cache.entries) == 2
+    # Same samples start from where the first converge ended
+    assert sig.converge(u, None).iters < first / 4
+    # Least recently used states are evicted
+    cache.budget = cache.size
+    sig.converge(u + 1, None)
+    assert len(cache.entries) == 2 and cache.size <= cache.budget
+    assert cache.get(eca.StateCache.fingerprint(u[:, ::-1], None)) is None
+
+
+def test_compiled_train():
+    u, y = data()
+    u[0, :5] = np.nan
+    schedule = dict(stiff=(0.5, 0.1, 0.9), min_tau=(0.0, 0.1, 0.8))
+    for Model in [TwoWayModel, DeepModel, DiagModel, DerivedPhiModel,
+                  FanInModel]:
+        mdl = Model()
+        init = [(p, p.get_value()) for p in params(mdl)]
+        y_ = y if mdl.Y else None
+        sig = mdl.new_signals(u.shape[1], backend='numpy')
+        s, t, ds = sig.train(u, y_, 4, **schedule)
+        assert len(ds) == 4
+        expected = [(k, x.val()) for k, x in sig.signal.items()]
+        phi = mdl.first_phi()
+        for bind in [False, True]:
+            for p, v in init:
+                p.set_value(v)
+            sig = mdl.new_signals(u.shape[1])
+            if bind:
+                sig.bind_input(u, y_)
+            # A single compiled loop of two steps continued by another
+            s_, t_, ds_ = sig.train(u, y_, 2, **schedule)
+            s_, t_, ds_ = sig.train(u, y_, 2, (s_, 0.1, 0.9), (t_, 0.1, 0.8))
+            assert np.isclose(s, s_) and np.isclose(t, t_)
+            assert np.allclose(ds[2:], ds_, atol=1e-4)
+            for k, v in expected:
+                assert np.allclose(sig.signal[k].val(), v, atol=1e-4), k
+            assert np.allclose(mdl.first_phi(), phi, atol=1e-4)
+
+
+def test_adapt_delta():
+    # On a stationary input the statistics settle and so does the delta
+    u, y = data()
+    mdl = TwoWayModel()
+    sig = mdl.new_signals(u.shape[1], backend='numpy')
+    s, t, ds = sig.train(u, y, 300, stiff=(0.5, 0.5, 1.0))
+    assert ds[0] > 1.0
+    assert ds[-1] < 0.01 * ds[0]
+
+
+def test_resize():
+    u, y = data()
+    mdl = TwoWayModel()
+    sig = mdl.new_signals(u.shape[1])
+    sig.converge(u, y)
+    sig.adapt_layers(0.5)
+    sig.u_est()
+    n = len(mdl.functions)
+    for k in [u.shape[1] - 7, 2 * u.shape[1], 3]:
+        uk, yk = np.tile(u, 2)[:, :k], np.tile(y, 2)[:, :k]
+        before = sig.U.val()
+        j = min(k, before.shape[1])
+        ref = mdl.new_signals(k)
+        sig.resize(k)
+        assert sig.k == k and sig.U.val().shape == (sig.U.n, k)
+        # Kept samples keep their states and new ones start from scratch
+        assert np.all(sig.U.val()[:, :j] == before[:, :j])
+        assert np.all(sig.U.val()[:, j:] == ref.U.val()[:, j:])
+        for key, s in ref.signal.items():
+            s.var.set_value(sig.signal[key].val())
+        for s in [sig, ref]:
+            s.propagate(uk, yk)
+        for key in ref.signal:
+            assert np.allclose(ref.signal[key].val(), sig.signal[key].val(),
+                               atol=1e-5), key
+        sig.converge(uk, yk)
+        sig.adapt_layers(0.5)
+        assert sig.u_est().shape == uk.shape
+    # The same functions serve any k
+    assert len(mdl.functions) == n
+
+
+def test_conv_layer():
+    compare(ConvModel, dict(backend='theano'), dict(backend='numpy'))
+    compare(ConvModel, dict(backend='theano'), dict(backend='theano',
+                                                    fused=True))
+    u, _ = data()
+    mdl = ConvModel()
+    sig = mdl.new_signals(u.shape[1], backend='numpy')
+    for i in range(3):
+        sig.propagate(u, None)
+        sig.adapt_layers(0.5)
+    l = mdl.X2
+    assert l.shape == (3, 2, 2) and l.n == 12 and l.get_phi().shape == (12, 2)
+    # Feedforward slides the filters over the images of X1
+    x1 = sig.signal['X1'].val().reshape(4, 3, 3, -1)
+    ff = np.zeros((3, 2, 2, u.shape[1]))
+    for i in range(3):
+        for j in range(2):
+            patch = x1[i:i + 2, j:j + 2].reshape(12, -1)
+            ff[i, j] = np.dot(l.get_phi().T, patch)
+    x1 = x1.reshape(36, -1)
+    assert np.allclose(l.phi_t_dot(sig.ops, x1), ff.reshape(12, -1), atol=1e-5)
+    # and feedback is its transpose
+    x2 = sig.signal['X2'].val()
+    assert np.isclose(np.sum(ff.reshape(12, -1) * x2),
+                      np.sum(x1 * l.phi_dot(sig.ops, 0, x2)), rtol=1e-4)
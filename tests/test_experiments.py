@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import numpy as np
 
 
 def test_unsupervised():
@@ -26,6 +27,26 @@ def test_unsupervised_conv_coates():
     mdl.run(dry_run=True)
 
 
+def test_coates_convolve():
+    from experiments.coates_unsupervised import ECAUnsupervised
+    w, k, stride, samples = 6, 5, 3, 7
+    rng = np.random.RandomState(0)
+    unsup = ECAUnsupervised(np.float32(rng.randn(w * w * 3, 200)), k)
+    unsup.learn(3)
+    inp = np.float32(rng.randn(32 * 32 * 3, samples))
+    conv = unsup.convolve(inp, w, stride, chunk=300)
+    # Each position transformed separately
+    expected = np.zeros((2, 2, k, samples))
+    d = inp.reshape(32, 32, 3, samples)
+    for x in xrange(0, 32 - w + 1, stride):
+        for y in xrange(0, 32 - w + 1, stride):
+            patch = d[x:x + w, y:y + w, :, :].reshape(w * w * 3, samples)
+            expected[x // 16, y // 16] += unsup.transform(patch)
+    expected = expected.reshape(4 * k, samples)
+    # Batching changes the features only at the level of convergence
+    assert np.abs(conv - expected).max() < 1e-3 * np.abs(expected).max()
+
+
 def test_imputation():
     import experiments.mnist_classification.imputation as mdl
     mdl.run(dry_run=True)
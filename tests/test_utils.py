@@ -1,9 +1,16 @@
-from utils import MnistDataset, Cifar10Dataset
+from utils import Dataset, MnistDataset, Cifar10Dataset
 import utils
 import numpy as np
 from eca import ECA, Input, Layer
 
 
+class RandomDataset(Dataset):
+    def load(self):
+        rng = np.random.RandomState(3)
+        self.data = {'trn': [np.float32(rng.randn(100, 20)),
+                             np.int32(rng.randint(10, size=100))]}
+
+
 def test_loading():
     for Dataset in [MnistDataset, Cifar10Dataset]:
         d = Dataset(batch_size=400,
@@ -49,3 +56,62 @@ def test_plots():
     utils.plot_Xdist(sig.U, axis=axis)
     utils.plot_qXphi(sig.U.next, axis=axis)
     utils.plot_svds(data.samples, sig.U, sig.U.next, axis=axis)
+
+
+def test_dataset_views():
+    d = RandomDataset(batch_size=30, as_one_hot=True, stacked=True)
+    labels = d.data['trn'][1]
+    for i in range(d.batches('trn')):
+        b = d.get('trn', i)
+        y = labels[i * 30:(i + 1) * 30]
+        assert b.labels.shape == (10, len(y)) and b.k == len(y)
+        assert np.all(np.argmax(b.labels, axis=0) == y)
+        assert np.all(np.sum(b.labels, axis=0) == 1.)
+        assert np.all(b.samples[-10:] == b.labels)
+        assert np.all(b.samples[:-10] == d.data['trn'][0][i * 30:(i + 1) * 30].T)
+    # Minibatches are views of the split built once
+    u, y = d.split('trn')
+    assert d.split('trn')[0] is u
+    assert np.may_share_memory(d.get('trn', 2).samples, u)
+    assert np.may_share_memory(d.get('trn', 2).labels, y)
+
+
+def test_dataset_cache(tmpdir):
+    fresh = RandomDataset(batch_size=30, as_one_hot=True)
+    utils.DATA_CACHE_DIR = str(tmpdir)
+    try:
+        RandomDataset(batch_size=30)
+        n = len(tmpdir.listdir())
+        assert all(p.ext in ('.npy', '.pkl') for p in tmpdir.listdir())
+        d = RandomDataset(batch_size=30, as_one_hot=True)
+        assert len(tmpdir.listdir()) == n
+        # Splits are shared read-only pages
+        assert isinstance(d.data['trn'][0], np.memmap)
+        assert not d.data['trn'][0].flags.writeable
+        assert np.allclose(d.get('trn', 1).samples, fresh.get('trn', 1).samples)
+        assert np.all(d.get('trn', 3).labels == fresh.get('trn', 3).labels)
+        # Normalization settings are cached separately
+        RandomDataset(batch_size=30, normalize=False)
+        assert len(tmpdir.listdir()) == 2 * n
+    finally:
+        utils.DATA_CACHE_DIR = None
+
+
+def test_patches():
+    d = RandomDataset()
+    d.data_shape = (4, 5, 1)
+    p = d.get_patches(w=2, m=50)
+    assert p.shape == (4, 50)
+    rng = np.random.RandomState(0)
+    x, y = rng.randint(2, size=50), rng.randint(3, size=50)
+    j = rng.randint(100, size=50)
+    pix = d.data['trn'][0].reshape(100, 4, 5, 1)
+    for i in range(50):
+        assert np.all(p[:, i] == pix[j[i], x[i]:x[i] + 2, y[i]:y[i] + 2].ravel())
+    batches = list(d.patch_batches(w=2, m=50, batch_size=20,
+                                   normalize_contrast=True))
+    assert [b.shape for b in batches] == [(4, 20), (4, 20), (4, 10)]
+    # Each patch is a column normalized to zero mean and unit variance
+    for b in batches:
+        assert np.allclose(np.mean(b, axis=0), 0.0, atol=1e-5)
+        assert np.allclose(np.std(b, axis=0), 1.0, atol=1e-4)
@@ -1,12 +1,19 @@
 import cPickle
 import gzip
+import hashlib
 import os
+import tempfile
 
 import theano.tensor as T
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
-rect = lambda x: T.where(x < 0., 0., x)
+# Directory for storing loaded and normalized datasets between runs, None
+# disables. The splits are opened as shared read-only memory maps.
+DATA_CACHE_DIR = None
+
+rect = lambda x: (np if isinstance(x, np.ndarray) else T).where(x < 0., 0., x)
 
 def rearrange_for_plot(w):
     """
@@ -98,8 +105,8 @@ def plot_qXphi(signal, n=int(1e5), axis=None):
     if axis is None:
         return
     en = np.mean(np.square(signal.val()), axis=1)
-    nphi = np.linalg.norm(signal.layer.phi[0].get_value(), axis=0)
-    Q = T.diagonal(signal.layer.Q).eval()
+    nphi = np.linalg.norm(signal.layer.get_phi(), axis=0)
+    Q = signal.layer.q()
     pen, = axis.plot(en[:n], 's-')
     pphi, = axis.plot(nphi[:n], '*-')
     pq, = axis.plot(Q[:n], 'x-')
@@ -185,11 +192,60 @@ class Dataset(object):
         self.as_one_hot = as_one_hot
         self.stacked = stacked
         assert not stacked or as_one_hot, 'stacking requires one hot'
+        # Whole splits in the layout get() slices minibatches from
+        self.views = {}
+        if DATA_CACHE_DIR and self.load_cached(normalize):
+            return
         self.load()
         if normalize:
             for x, y in self.data.values():
                 x -= np.mean(x, axis=0, keepdims=True)
                 x /= np.maximum(np.std(x, axis=0, keepdims=True), 1e-10)
+        if DATA_CACHE_DIR:
+            self.store_cached(normalize)
+
+    def cache_path(self, normalize, part):
+        name = type(self).__name__
+        h = hashlib.sha1(repr((name, self.testset_size, normalize))).hexdigest()
+        return os.path.join(DATA_CACHE_DIR, '%s-%s-%s' % (name, h[:16], part))
+
+    def store_cached(self, normalize):
+        """
+        Store each split as float32 .npy files, the metadata is written
+        last so that an interrupted store is never loaded.
+        """
+        if not os.path.exists(DATA_CACHE_DIR):
+            os.makedirs(DATA_CACHE_DIR)
+
+        def write(part, dump):
+            # Unique temporary names keep concurrent first runs apart
+            fd, tmp = tempfile.mkstemp(dir=DATA_CACHE_DIR)
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    dump(fp)
+                os.rename(tmp, self.cache_path(normalize, part))
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+        for type, (x, y) in self.data.items():
+            for part, a in [('u', np.float32(x)), ('y', y)]:
+                write(type + '-' + part + '.npy', lambda fp: np.save(fp, a))
+        meta = (getattr(self, 'data_shape', None), self.data.keys())
+        write('meta.pkl',
+              lambda fp: cPickle.dump(meta, fp, cPickle.HIGHEST_PROTOCOL))
+
+    def load_cached(self, normalize):
+        """ Open the splits stored by store_cached(), if there are any """
+        path = self.cache_path(normalize, 'meta.pkl')
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as fp:
+            self.data_shape, types = cPickle.load(fp)
+        load = lambda type, part: np.load(
+            self.cache_path(normalize, type + '-' + part + '.npy'), mmap_mode='r')
+        self.data = dict((t, [load(t, 'u'), load(t, 'y')]) for t in types)
+        return True
 
     def size(self, type):
         assert type in self.data.keys(), 'type has to be in %s' % str(self.data.keys())
@@ -200,62 +256,79 @@ class Dataset(object):
     def samples(self, type):
         return self.data[type][0][:self.batch_size].shape[0]
 
+    def batches(self, type):
+        """ Number of minibatches in the split, the last may be partial """
+        return -(-len(self.data[type][0]) // self.batch_size)
+
     def dims(self, type):
         y_dim = 10 if self.as_one_hot else 1
         u_dim = self.data[type][0].shape[1]
         u_dim += y_dim if self.stacked else 0
         return (u_dim, y_dim)
 
+    def split(self, type):
+        """
+        Returns a tuple (u, y) of the whole split with samples as columns,
+        labels one-hot coded and stacked under the samples if requested.
+        They are built once, so minibatches are views of them and must not
+        be modified in place.
+        """
+        assert type in self.data.keys(), 'type has to be in %s' % str(self.data.keys())
+        if type in self.views:
+            return self.views[type]
+        (u, y) = self.data[type]
+        u = u.T
+        if self.as_one_hot:
+            # Convert into one_hot presentation 2 -> [0, 0, 1, 0, ...]
+            y_ = np.zeros((10, len(y)), dtype=np.float32)
+            y_[y, np.arange(len(y))] = 1.
+            y = y_
+            if self.stacked:
+                u = np.vstack([u, y if type == 'trn' else np.float32(np.nan * y)])
+        self.views[type] = (u, y)
+        return u, y
+
     def get(self, type, i=None):
         """
         Returns a tuple (u, y) of i'th minibatch expanded into a one-hot coded vectors if necessary.
 
         E.g. 5 -> [0, 0, 0, 0, 0, 1, 0, 0, 0, 0]
         """
-        assert type in self.data.keys(), 'type has to be in %s' % str(self.data.keys())
-        (u, y) = self.data[type]
+        (u, y) = self.split(type)
 
         i = 0 if i is None else i
         start = i * self.batch_size
-        end = min(u.shape[0], (i + 1) * self.batch_size)
-
-        u = u[start:end].T
-
-        if not self.as_one_hot:
-            return Dataset.Data(u, y[start:end].T, type)
-
-        # Convert into one_hot presentation 2 -> [0, 0, 1, 0, ...]
-        y_ = np.array(np.zeros(10))
-        y_[y[start]] = 1.
-        for i in range(start + 1, end):
-            new = np.zeros(10)
-            new[y[i]] = 1.
-            y_ = np.vstack((y_, new))
-        y_ = np.float32(y_.T)
-        if self.stacked:
-            if type == 'trn':
-                u = np.vstack([u, y_])
-            else:
-                u = np.vstack([u, np.float32(np.nan * y_)])
-        return MnistDataset.Data(u, y_, type)
+        end = min(u.shape[1], (i + 1) * self.batch_size)
+        return Dataset.Data(u[:, start:end], y[..., start:end], type)
 
     def get_patches(self, w=8, m=10000, normalize_contrast=False):
-        patches = []
+        """ Returns m random w x w patches of the training images as columns """
+        return next(self.patch_batches(w, m, m, normalize_contrast))
+
+    def patch_batches(self, w=8, m=10000, batch_size=1000,
+                      normalize_contrast=False):
+        """
+        Generates m random w x w patches of the training images in batches
+        of batch_size columns. Patches are gathered from a strided view of
+        all window positions, so only the patches themselves are copied.
+        """
         rng = np.random.RandomState(seed=0)
         pix = self.data['trn'][0]
         pix = pix.reshape((pix.shape[0],) + self.data_shape)
         width, height, chans = self.data_shape
-        for i in xrange(m):
-            x, y = rng.randint(width - w), rng.randint(height - w)
-            j = rng.randint(len(pix))
-            patches += [pix[j, x:x+w, y:y+w, :chans].reshape(w * w * chans)]
-
-        patches = np.array(patches)
-        if normalize_contrast:
-            patches -= np.mean(patches, axis=1, keepdims=True)
-            patches /= np.maximum(np.std(patches, axis=1, keepdims=True), 1e-10)
-
-        return patches.T
+        s = pix.strides
+        windows = as_strided(pix, strides=s[:3] + s[1:],
+                             shape=(len(pix), width - w + 1, height - w + 1,
+                                    w, w, chans))
+        for start in xrange(0, m, batch_size):
+            b = min(batch_size, m - start)
+            x, y = rng.randint(width - w, size=b), rng.randint(height - w, size=b)
+            j = rng.randint(len(pix), size=b)
+            patches = windows[j, x, y].reshape(b, w * w * chans)
+            if normalize_contrast:
+                patches -= np.mean(patches, axis=1, keepdims=True)
+                patches /= np.maximum(np.std(patches, axis=1, keepdims=True), 1e-10)
+            yield patches.T
 
 
 class MnistDataset(Dataset):